@@ -1,14 +1,48 @@
 'api_service.py'
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Body
+from fastapi.responses import Response, StreamingResponse
 import datetime
 
-from server.res_system import ReservationSystem as db_sys
+from server import logs
+from server.executor import Overloaded
+from server.metrics import REGISTRY, MetricsMiddleware
+from server.profiler import ORDERS
+from server.res_system import AsyncReservationSystem as db_sys
+from server.serialize import dumps
+from server.settings import LIST_PAGE_SIZE, LIST_PAGE_SIZE_MAX, METRICS, STREAM_FETCH_SIZE
 
-app = FastAPI()
+logs.configure()
 sys = db_sys()
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Closes the aiosqlite connection and flushes the logs when the server shuts down"""
+    yield
+    await sys.db.close()
+    logs.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+if METRICS:
+    app.add_middleware(MetricsMiddleware)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, exc: Overloaded):
+    """Answers a call the database pools refused with 503, so clients back off and retry"""
+    return JSONBytesResponse({"success": False, "message": f"ERROR - {exc}"}, status_code=503,
+                             headers={"Retry-After": "1"})
+
+
+@app.get("/metrics")
+async def metrics():
+    """Returns the request, query and connection metrics in the Prometheus text format"""
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/reservation/post")
 async def reserve_item(reservation: dict = Body(...)):
     """Given a machine type and datetime, calls the reservation method
@@ -26,7 +60,6 @@ async def reserve_item(reservation: dict = Body(...)):
     """
 
     details = reservation
-    print(details)
 
     try:
 
@@ -35,7 +68,7 @@ async def reserve_item(reservation: dict = Body(...)):
         end = datetime.datetime.strptime(details["end_time"], "%Y-%m-%d %H:%M")
 
 
-        downpayment = sys.make_reservation(
+        downpayment = await sys.make_reservation(
             details["user_name"], 
             details["equipment_name"], 
             start, end,
@@ -49,13 +82,56 @@ async def reserve_item(reservation: dict = Body(...)):
     return {"success": success, "message": message}
 
 
+@app.post("/reservation/bulk")
+async def reserve_items(reservations: list = Body(...)):
+    """Given a list of reservations, calls the make_reservations method
+    and returns the result of each one
+
+    All accepted reservations are written in a single transaction
+    
+    Parameters
+    ----------
+    - reservations : json
+        list of json objects, each containing start_time, end_time, user_name, equip_name, x_coor, y_coor
+    
+    Returns
+    -------
+    - json
+        json containing success and message, a list with success, message and downpayment per reservation
+    """
+
+    batch = []
+    results = []
+
+    for details in reservations:
+        try:
+            start = datetime.datetime.strptime(details["start_time"], "%Y-%m-%d %H:%M")
+            end = datetime.datetime.strptime(details["end_time"], "%Y-%m-%d %H:%M")
+            batch.append((details["user_name"], details["equipment_name"], start, end,
+                          details["x_coor"], details["y_coor"]))
+            results.append(None)
+        except (KeyError, TypeError, ValueError) as e:
+            results.append({"success": False, "message": f"ERROR - {e}", "downpayment": 0})
+
+    made = iter(await sys.make_reservations(batch))
+    results = [result if result is not None else next(made) for result in results]
+
+    return {"success": True, "message": results}
+
+
 @app.get("/reservation/getall")
-async def get_all_reservations():
-    """Returns all reservations in the database
+async def get_all_reservations(request: Request, limit: int = None, cursor: int = None, stream: bool = False):
+    """Returns all reservations in the database, a page at a time
 
     Parameters
     ----------
-    None
+    - limit : int
+        most reservations returned in one page
+    - cursor : int
+        next_cursor of the previous page, omit for the first page
+    - stream : bool
+        send one json object per line as they are read, also chosen by
+        `Accept: application/x-ndjson`; a stream is not paged unless limit is given
 
     Returns
     -------
@@ -63,12 +139,13 @@ async def get_all_reservations():
         json containing success and message
     """
     try:
-        reservations = sys.list_all_reservations()
-        success = True
+        stream = wants_stream(request, stream)
+        reservations = await sys.list_all_reservations(page_size(limit, stream), cursor, stream, encoded=True)
     except ValueError as e:
-        success = False
-        reservations = f"ERROR - {e}"
-    return {"success": success, "message": reservations}
+        return {"success": False, "message": f"ERROR - {e}"}
+    if stream:
+        return ndjson_response(reservations)
+    return listing_response(reservations)
 
 
 @app.delete("/reservation/cancel")
@@ -86,7 +163,7 @@ async def delete_reservation(id: int):
         json containing success, message and refund
     """
     try:
-        refund = sys.cancel_reservation(id)
+        refund = await sys.cancel_reservation(id)
         success = True
         test_message = "Succesfully cancelled reservation"
     except ValueError as e:
@@ -96,8 +173,45 @@ async def delete_reservation(id: int):
     return {"success": success, "message": test_message, "refund": refund}
 
 
+@app.delete("/reservation/cancel/bulk")
+async def delete_reservations(selection: dict = Body(...)):
+    """Given reservation ids or a filter, calls the cancel_reservations method
+
+    All matching reservations are cancelled in a single transaction, start and
+    end time must be in the format YYYY-MM-DD HH:MM
+
+    Parameters
+    ----------
+    - selection : json
+        json containing either ids, a list of reservation ids, or any of user_name,
+        equipment_name and start with end
+
+    Returns
+    -------
+    - json
+        json containing success, message, the refund per cancelled reservation and the total refund
+    """
+    try:
+        for key in ("user_name", "equipment_name", "start", "end"):
+            if selection.get(key) is not None and not isinstance(selection[key], str):
+                raise ValueError(f"{key} must be a string")
+        start = selection.get("start")
+        end = selection.get("end")
+        cancelled = await sys.cancel_reservations(
+            selection.get("ids"), selection.get("user_name"), selection.get("equipment_name"),
+            prep_datetime(start) if start is not None else None, prep_datetime(end) if end is not None else None)
+        success = True
+        test_message = f"Succesfully cancelled {len(cancelled['refunds'])} reservations"
+    except (TypeError, ValueError) as e:
+        success = False
+        test_message = f"ERROR - {e}"
+        cancelled = {"refunds": [], "total_refund": 0}
+    return {"success": success, "message": test_message, **cancelled}
+
+
 @app.get("/reservation/getbytime")
-async def get_reservations(start: str, end: str):
+async def get_reservations(request: Request, start: str, end: str, limit: int = None, cursor: int = None,
+                           stream: bool = False):
     """Given a start and end time, calls the list_reservations method
     
     start and end time must be in the format YYYY-MM-DD HH:MM
@@ -108,6 +222,13 @@ async def get_reservations(start: str, end: str):
         start time of the reservation
     - end : str
         end time of the reservation
+    - limit : int
+        most reservations returned in one page
+    - cursor : int
+        next_cursor of the previous page, omit for the first page
+    - stream : bool
+        send one json object per line as they are read, also chosen by
+        `Accept: application/x-ndjson`; a stream is not paged unless limit is given
 
     Returns
     -------
@@ -118,12 +239,16 @@ async def get_reservations(start: str, end: str):
     start = prep_datetime(start)
     end = prep_datetime(end)
 
-    reservations = sys.list_reservations(start, end)
-    return {"success": True, "message": reservations}
+    stream = wants_stream(request, stream)
+    reservations = await sys.list_reservations(start, end, page_size(limit, stream), cursor, stream, encoded=True)
+    if stream:
+        return ndjson_response(reservations)
+    return listing_response(reservations)
 
 
 @app.get("/reservation/getbyuser")
-async def get_customer_reservations(user_name, start, end):
+async def get_customer_reservations(request: Request, user_name, start, end, limit: int = None, cursor: int = None,
+                                    stream: bool = False):
     """Given a user name, start and end time, calls the list_customer_reservations method
     
     start and end time must be in the format YYYY-MM-DD HH:MM
@@ -136,6 +261,13 @@ async def get_customer_reservations(user_name, start, end):
         start time of the reservation
     - end : str
         end time of the reservation
+    - limit : int
+        most reservations returned in one page
+    - cursor : int
+        next_cursor of the previous page, omit for the first page
+    - stream : bool
+        send one json object per line as they are read, also chosen by
+        `Accept: application/x-ndjson`; a stream is not paged unless limit is given
 
     Returns
     -------
@@ -147,13 +279,18 @@ async def get_customer_reservations(user_name, start, end):
     start = prep_datetime(start)
     end = prep_datetime(end)
 
-    reservations = sys.list_customer_reservations(user_name.strip("'"), start, end)
+    stream = wants_stream(request, stream)
+    reservations = await sys.list_customer_reservations(user_name.strip("'"), start, end,
+                                                        page_size(limit, stream), cursor, stream, encoded=True)
+    if stream:
+        return ndjson_response(reservations)
 
-    return {"success": True, "message": reservations}
+    return listing_response(reservations)
 
 
 @app.get("/reservation/getbyequip")
-async def get_machine_reservations(equipment_name, start, end):
+async def get_machine_reservations(request: Request, equipment_name, start, end, limit: int = None,
+                                   cursor: int = None, stream: bool = False):
     """Given a machine name, start and end time, calls the list_machine_reservations method
 
     start and end time must be in the format YYYY-MM-DD HH:MM
@@ -166,6 +303,13 @@ async def get_machine_reservations(equipment_name, start, end):
         start time of the reservation
     - end : str
         end time of the reservation
+    - limit : int
+        most reservations returned in one page
+    - cursor : int
+        next_cursor of the previous page, omit for the first page
+    - stream : bool
+        send one json object per line as they are read, also chosen by
+        `Accept: application/x-ndjson`; a stream is not paged unless limit is given
 
     Returns
     -------
@@ -176,14 +320,83 @@ async def get_machine_reservations(equipment_name, start, end):
     start = prep_datetime(start)
     end = prep_datetime(end)
     equipment_input = equipment_name.strip("'")
-    equipment = sys._find_equipment(equipment_input)
+    equipment = await sys._find_equipment(equipment_input)
 
     if equipment is None:
         return {"success": False, "message": f"Machine not found - user entered '{equipment_input}'"}
 
-    reservations = sys.list_machine_reservations(equipment_name.strip("'"), start, end)
+    stream = wants_stream(request, stream)
+    reservations = await sys.list_machine_reservations(equipment_name.strip("'"), start, end,
+                                                       page_size(limit, stream), cursor, stream, encoded=True)
+    if stream:
+        return ndjson_response(reservations)
+
+    return listing_response(reservations)
+
+
+@app.get("/reservation/availability/next")
+async def get_next_available(equipment_name, duration: int, after: str = None, count: int = 1):
+    """Given a machine name and a duration, calls the next_available method
+
+    after must be in the format YYYY-MM-DD HH:MM
+
+    Parameters
+    ----------
+    - equipment_name : str
+        name of the machine
+    - duration : int
+        length of the booking in minutes
+    - after : str
+        earliest start, now when omitted
+    - count : int
+        number of free windows to return, at most LIST_PAGE_SIZE_MAX
+
+    Returns
+    -------
+    - json
+        json containing success, message and starts, the earliest start of each free window
+    """
+    try:
+        after = prep_datetime(after) if after is not None else datetime.datetime.now().replace(second=0, microsecond=0)
+        starts = await sys.next_available(equipment_name.strip("'"), datetime.timedelta(minutes=duration), after,
+                                          min(count, LIST_PAGE_SIZE_MAX))
+    except ValueError as e:
+        return {"success": False, "message": f"ERROR - {e}", "starts": []}
+    return {"success": True, "message": f"{len(starts)} free windows found",
+            "starts": [start.strftime("%Y-%m-%d %H:%M") for start in starts]}
+
+
+@app.get("/reservation/occupancy")
+async def get_occupancy(start: str, end: str, equipment_name: str = None, bucket: str = "1h"):
+    """Given a time period and a bucket length, calls the occupancy method
+
+    start and end time must be in the format YYYY-MM-DD HH:MM
+
+    Parameters
+    ----------
+    - equipment_name : str
+        name of the machine, every machine when omitted
+    - start : str
+        start of the first bucket
+    - end : str
+        end of the time period
+    - bucket : str
+        length of a bucket, a number of minutes, hours or days such as 15m, 1h or 1d
 
-    return {"success": True, "message": reservations}
+    Returns
+    -------
+    - json
+        json containing success, message, the start of every bucket and, per machine,
+        the available units and the most units in use at once in every bucket
+    """
+    try:
+        occupancy = await sys.occupancy(equipment_name.strip("'") if equipment_name is not None else None,
+                                        prep_datetime(start), prep_datetime(end), prep_bucket(bucket))
+    except ValueError as e:
+        return {"success": False, "message": f"ERROR - {e}", "starts": [], "equipment": {}}
+    return {"success": True, "message": f"{len(occupancy['starts'])} buckets",
+            "starts": [bucket_start.strftime("%Y-%m-%d %H:%M") for bucket_start in occupancy["starts"]],
+            "equipment": occupancy["equipment"]}
 
 #TODO: @kanello to do this
 @app.get("/reservation/user")
@@ -192,10 +405,9 @@ async def user_login(username):
     username_input = username.strip("'")
 
     # return user roles with numbers 0, 1,2
-    user = sys.login_user(username_input)
+    user = await sys.login_user(username_input)
     if user :
         user=user[0]
-        print(user)
         return {"success": True, "id": user[0], "role": user[4], "username": username, "first_name": user[2]}
     
     return {"success": False, "message": f"User not found - user entered '{username_input}'"}
@@ -208,7 +420,7 @@ async def confirm_access(reservation_id):
     """Check that this user is the reservation owner"""
     reservation_id_input = reservation_id.strip("'")
 
-    username = sys.db.select("reservations_view", "username", f"reservation_id = {reservation_id_input}")
+    username = await sys.db.select("reservations_view", "username", "reservation_id = ?", (reservation_id_input,))
 
     if username is None:
         return {"success": False, "message": f"Reservation not found - user entered '{reservation_id_input}'"}
@@ -226,7 +438,7 @@ async def add_user(username, first_name, role):
     first_name_input = first_name.strip("'")
     role_input = role.strip("'")
 
-    sys.add_user(username_input, first_name_input, role_input)
+    await sys.add_user(username_input, first_name_input, role_input)
 
     return {"success": True, "message": f"User {username_input} added"}
 
@@ -240,10 +452,10 @@ async def change_user_role(username, role):
     role_input = role.strip("'")
 
     # check if user exists
-    if sys._find_user(username_input) is None:
+    if await sys._find_user(username_input) is None:
         return {"success": False, "message": f"User not found - user entered '{username_input}'"}
     
-    sys.change_user_role(username_input, role_input)
+    await sys.change_user_role(username_input, role_input)
 
     return {"success": True, "message": f"User {username_input} changed to {role_input}"}
 
@@ -257,22 +469,115 @@ async def remove_user(username):
     username_input = username.strip("'")
 
     # check if user exists
-    if sys._find_user(username_input) is None:
+    if await sys._find_user(username_input) is None:
         return {"success": False, "message": f"User not found - user entered '{username_input}'"}
     
 
-    sys.remove_user(username_input)
+    await sys.remove_user(username_input)
 
     return {"success": True, "message": f"User {username_input} removed"}
 
 @app.get("/reservation/user/getall")
-async def get_all_users():
+async def get_all_users(request: Request, limit: int = None, cursor: int = None, stream: bool = False):
     """
-    get all users from the database
+    get all users from the database, a page at a time
+
+    pass the next_cursor of a page as cursor to get the page after it,
+    or ask for `stream` / `Accept: application/x-ndjson` to get one user per line
     """
-    users = sys.list_all_users()
+    stream = wants_stream(request, stream)
+    users = await sys.list_all_users(page_size(limit, stream), cursor, stream, encoded=True)
+    if stream:
+        return ndjson_response(users)
 
-    return {"success": True, "message": users}
+    return listing_response(users)
+
+@app.get("/reservation/admin/slowqueries")
+async def slow_queries(count: int = 10, order: str = "total"):
+    """Returns the slowest statement templates seen by the query profiler
+
+    Parameters
+    ----------
+    - count : int
+        number of statement templates to return
+    - order : str
+        rank them by "total", "mean" or "max" time
+
+    Returns
+    -------
+    - json
+        json containing success and message, the templates with their timings and query plans
+    """
+    if sys.db.profiler is None:
+        return {"success": False, "message": "Query profiling is off, start the server with RES_PROFILE_QUERIES=1"}
+    if order not in ORDERS:
+        return {"success": False, "message": f"Unknown order '{order}'"}
+
+    return {"success": True, "message": sys.db.profiler.top(count, order)}
 
 def prep_datetime(date_time):
     return datetime.datetime.strptime(date_time.strip("'"), "%Y-%m-%d %H:%M")
+
+
+BUCKET_UNITS = {"m": "minutes", "h": "hours", "d": "days"}
+
+
+def prep_bucket(bucket):
+    """Reads a bucket length such as 15m, 1h or 1d"""
+    bucket = bucket.strip("'")
+    message = f"Bucket must be a number of minutes, hours or days such as 1h, not '{bucket}'"
+    if bucket[-1:] not in BUCKET_UNITS or not bucket[:-1].isdigit():
+        raise ValueError(message)
+    try:
+        return datetime.timedelta(**{BUCKET_UNITS[bucket[-1]]: int(bucket[:-1])})
+    except OverflowError:
+        raise ValueError(message) from None
+
+
+def page_size(limit, stream=False):
+    if limit is None:
+        # a stream holds one chunk at a time, so by default it runs to the end
+        return None if stream else LIST_PAGE_SIZE
+    return min(max(limit, 1), LIST_PAGE_SIZE_MAX)
+
+
+def wants_stream(request, stream):
+    return stream or "application/x-ndjson" in request.headers.get("accept", "")
+
+
+class JSONBytesResponse(Response):
+    """Sends json that is already encoded as is, and encodes anything else with
+    server.serialize instead of going through jsonable_encoder"""
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+def listing_response(listing):
+    """Wraps a listing encoded by the reservation system in the usual success envelope"""
+
+    return JSONBytesResponse(b'{"success":true,"message":' + listing + b"}")
+
+
+def ndjson_response(rows):
+    """Streams an async iterator of json encoded rows as newline delimited json
+
+    Rows are encoded as they come off the database cursor and sent in chunks of
+    STREAM_FETCH_SIZE lines, so memory and time to first byte do not grow with
+    the size of the listing."""
+
+    async def lines():
+        chunk = []
+        async for row in rows:
+            chunk.append(row)
+            if len(chunk) == STREAM_FETCH_SIZE:
+                yield b"\n".join(chunk) + b"\n"
+                chunk = []
+        if chunk:
+            yield b"\n".join(chunk) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
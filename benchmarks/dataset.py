@@ -0,0 +1,264 @@
+"""Synthetic dataset generator
+
+Creates a reservation database of any size for benchmarks and capacity tests.
+The schema and the hand written seed rows come from the migrations as usual;
+on top of them the generator adds users with their roles, extra roles, machines
+and reservations:
+
+- reservations start on the half hour, mostly on weekdays during working hours,
+  last from half an hour to a day (one to two hours most often) and are spread
+  over --years from --start; popular machines and users get more of them
+- a --cancelled share is cancelled, those no longer hold a unit
+- active reservations overlap, but never more than a machine's available units:
+  a request for a fully booked machine is moved to the moment a unit frees up
+- cost follows the service's pricing, the early booking discount included
+
+The same seed always gives the same database. Rows are loaded with executemany
+in one transaction, without a journal, and the reservation indexes and triggers
+are created after the load, so ten million reservations take minutes.
+
+    python -m benchmarks.dataset big.db --reservations 10000000 --users 100000 --machines 200 --seed 1
+"""
+
+import argparse
+import bisect
+import datetime
+import heapq
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import time
+from array import array
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from server.db_migrations import MigrationRunner  # noqa: E402
+from server.db_utils import DBUtils, to_epoch  # noqa: E402
+
+HALF_HOUR = 1800
+DAY = 86400
+# relative weight of a start at each hour of the day
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 4, 10, 16, 18, 18, 16, 12, 15, 16, 15, 12, 8, 5, 3, 2, 2, 1, 1]
+# share of the requests on a saturday or sunday that are kept
+WEEKEND_SHARE = 0.3
+# durations in half hours and their weights, from half an hour to a day
+DURATIONS = [1, 2, 3, 4, 6, 8, 12, 16, 24, 48]
+DURATION_WEIGHTS = [8, 30, 14, 20, 9, 7, 5, 3, 2, 2]
+# days between booking and start, the cost is discounted from 14 days on
+LEAD_DAYS = [0, 1, 2, 3, 7, 14, 30, 60]
+LEAD_WEIGHTS = [5, 10, 10, 10, 20, 20, 15, 10]
+FIRST_NAMES = ["Ada", "Alan", "Barbara", "Claude", "Donald", "Edsger", "Frances", "Grace", "John", "Katherine",
+               "Leslie", "Margaret", "Niklaus", "Radia", "Shafi", "Tim", "Ursula", "Vint", "Whitfield", "Yukihiro"]
+
+
+def zipf_weights(count: int, exponent: float = 1.0) -> list:
+    """Cumulative weights where the i-th item is 1 / i^exponent as likely as the first"""
+
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def price(hourly_cost: float, seconds: int, lead_days: int) -> float:
+    """The service's pricing, see ReservationSystem._price"""
+
+    return seconds / 3600 * hourly_cost * (0.75 if lead_days >= 14 else 1)
+
+
+class Generator:
+    """Draws the users, machines and reservations of a dataset
+
+    Parameters
+    ----------
+    seed: int
+        - Every draw follows from it
+    start: datetime.datetime
+        - The earliest reservation start
+    years: float
+        - The length of the period the reservations start in
+    cancelled: float
+        - The share of reservations that are cancelled"""
+
+    def __init__(self, seed: int, start: datetime.datetime, years: float, cancelled: float):
+        self.seed = seed
+        self.first = to_epoch(start) // DAY * DAY
+        self.days = max(1, int(years * 365))
+        self.cancelled = cancelled
+        self.hours = list(itertools.accumulate(HOUR_WEIGHTS))
+
+    def users(self, count: int, first_id: int) -> list:
+        """(username, first_name, active) of `count` users, a few of them deactivated"""
+
+        rng = random.Random(f"{self.seed}-users")
+        return [(f"user{first_id + i:07d}", rng.choice(FIRST_NAMES), "TRUE" if rng.random() > 0.02 else "FALSE")
+                for i in range(count)]
+
+    def machines(self, count: int) -> list:
+        """(equipment, available, hourly cost) of `count` machines"""
+
+        rng = random.Random(f"{self.seed}-machines")
+        return [(f"machine {i:04d}", rng.choice([1, 1, 2, 4, 8, 16, 50]), rng.choice([4, 25, 90, 250, 990, 5000]))
+                for i in range(1, count + 1)]
+
+    def starts(self, rng: random.Random, count: int) -> list:
+        """`count` sorted half hour starts, weighted to weekdays and working hours"""
+
+        starts = []
+        while len(starts) < count:
+            day = rng.randrange(self.days)
+            # the epoch began on a thursday, so (day + 3) % 7 is 5 or 6 on weekends
+            if (self.first // DAY + day + 3) % 7 >= 5 and rng.random() > WEEKEND_SHARE:
+                continue
+            hour = bisect.bisect(self.hours, rng.random() * self.hours[-1])
+            starts.append(self.first + day * DAY + hour * 3600 + HALF_HOUR * rng.randrange(2))
+        starts.sort()
+        return starts
+
+    def reservations(self, machine: tuple, index: int, count: int, usernames: list, user_weights: list,
+                     booked: list = ()):
+        """Yields (start, row) of `count` reservations of one machine, in start order
+
+        Active reservations are checked against the units of the machine with a heap
+        of the end times of the ones still running; a request that finds every unit
+        taken starts when the first of them ends instead. Later requests count that
+        moved reservation as running from their own start, which may refuse a few
+        more than needed but never books a unit twice.
+
+        Parameters
+        ----------
+        booked: list
+            - (start, end) of the active reservations the machine already has, they hold their units too"""
+
+        equipment, available, hourly_cost = machine
+        rng = random.Random(f"{self.seed}-reservations-{index}")
+        running = []
+        booked = sorted(booked, reverse=True)
+        for start in array("q", self.starts(rng, count)):
+            while booked and booked[-1][0] <= start:
+                heapq.heappush(running, booked.pop()[1])
+            seconds = HALF_HOUR * rng.choices(DURATIONS, DURATION_WEIGHTS)[0]
+            active = rng.random() >= self.cancelled
+            if active:
+                while running and running[0] <= start:
+                    heapq.heappop(running)
+                full = len(running) >= available
+                if full:
+                    start = running[0]
+                # booked reservations starting within the new one take units as well,
+                # without one to spare the request is given up and stays cancelled
+                ahead = sum(1 for booked_start, _ in booked if booked_start < start + seconds)
+                if len(running) - full + ahead < available:
+                    (heapq.heapreplace if full else heapq.heappush)(running, start + seconds)
+                else:
+                    active = False
+            lead_days = rng.choices(LEAD_DAYS, LEAD_WEIGHTS)[0]
+            cost = price(hourly_cost, seconds, lead_days)
+            username = rng.choices(usernames, cum_weights=user_weights)[0]
+            location = f"{rng.randint(1, 20)} {rng.randint(1, 20)}"
+            yield start, (username, equipment, start, start + seconds, int(active), cost, cost / 2, location)
+
+
+def split(total: int, weights: list) -> list:
+    """Splits `total` into integer parts proportional to cumulative `weights`"""
+
+    shares = [weight - previous for previous, weight in zip([0] + weights, weights)]
+    parts = [int(total * share / weights[-1]) for share in shares]
+    parts[0] += total - sum(parts)
+    return parts
+
+
+def generate(path: str, reservations: int, users: int, machines: int, roles: int, seed: int,
+             start: datetime.datetime, years: float, cancelled: float, batch: int = 100000) -> dict:
+    """Creates the database at `path` and returns the number of rows added per table"""
+
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} exists, the generator only creates new databases")
+
+    db = DBUtils(path, readers=1, group_commit=False)
+    MigrationRunner(db).run()
+    db.close()
+
+    generator = Generator(seed, start, years, cancelled)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")
+    conn.execute("BEGIN")
+
+    # roles: the seeded ones plus numbered extras
+    role_ids = [row[0] for row in conn.execute("SELECT role_id FROM roles ORDER BY role_id")]
+    extra_roles = [(f"role {i}",) for i in range(len(role_ids) + 1, roles + 1)]
+    conn.executemany("INSERT INTO roles (role) VALUES (?)", extra_roles)
+    role_ids = [row[0] for row in conn.execute("SELECT role_id FROM roles ORDER BY role_id")]
+
+    # users, most of them customers
+    first_id = conn.execute("SELECT coalesce(max(user_id), 0) + 1 FROM users").fetchone()[0]
+    new_users = generator.users(users, first_id)
+    conn.executemany("INSERT INTO users (username, first_name, active) VALUES (?, ?, ?)", new_users)
+    rng = random.Random(f"{seed}-roles")
+    conn.executemany("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)",
+                     ((first_id + i, role_ids[1] if rng.random() < 0.9 else rng.choice(role_ids))
+                      for i in range(users)))
+
+    conn.executemany("INSERT INTO machines (equipment, available, cost) VALUES (?, ?, ?)",
+                     generator.machines(machines))
+    all_machines = conn.execute("SELECT equipment, available, cost FROM machines").fetchall()
+    usernames = [row[0] for row in conn.execute("SELECT username FROM users WHERE active = 'TRUE'")]
+    # popular machines and users book more, ranked in a shuffled but seeded order
+    random.Random(f"{seed}-popularity").shuffle(usernames)
+    user_weights = zipf_weights(len(usernames), 0.8)
+    counts = split(reservations, zipf_weights(len(all_machines), 0.7))
+    booked = {}
+    for equipment, start_date, end_date in conn.execute(
+            "SELECT equipment, start_date, end_date FROM reservations WHERE active = 1"):
+        booked.setdefault(equipment, []).append((start_date, end_date))
+
+    # the indexes are built once after the load, not updated row by row, and the generated
+    # history is not written to the reservation_changes log, the workers load it whole
+    indexes = conn.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') "
+                           "AND tbl_name = 'reservations' AND sql IS NOT NULL").fetchall()
+    for kind, name, _ in indexes:
+        conn.execute(f"DROP {kind} {name}")
+
+    # merging the machines in start order makes the ids follow time, as they would in service
+    rows = (row for _, row in heapq.merge(
+        *(generator.reservations(machine, i, count, usernames, user_weights, booked.get(machine[0], ()))
+          for i, (machine, count) in enumerate(zip(all_machines, counts))),
+        key=lambda item: item[0]))
+    insert = ("INSERT INTO reservations (username, equipment, start_date, end_date, active, cost, downpayment, "
+              "location) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    while chunk := list(itertools.islice(rows, batch)):
+        conn.executemany(insert, chunk)
+
+    for _, _, sql in indexes:
+        conn.execute(sql)
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+    return {"roles": len(extra_roles), "users": users, "machines": machines, "reservations": reservations}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", help="database file to create")
+    parser.add_argument("--reservations", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--machines", type=int, default=20)
+    parser.add_argument("--roles", type=int, default=3, help="roles in total, the three seeded ones included")
+    parser.add_argument("--cancelled", type=float, default=0.1, help="share of cancelled reservations")
+    parser.add_argument("--start", default="2020-01-01", help="first day reservations start on, YYYY-MM-DD")
+    parser.add_argument("--years", type=float, default=5.0, help="years the reservations start over")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    added = generate(args.path, args.reservations, args.users, args.machines, args.roles, args.seed,
+                     datetime.datetime.strptime(args.start, "%Y-%m-%d"), args.years, args.cancelled)
+    print(f"added {added} to {args.path} in {time.perf_counter() - began:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""Load test for api_service
+
+Drives a weighted mix of requests at the service and prints a JSON report with
+the throughput, latency percentiles and error rate of every endpoint and of the
+whole run, so two builds can be compared.
+
+The service is either the `app` itself, called in process through httpx's ASGI
+transport on a database in a fresh working directory (or --workdir), or a running
+server given with --url. Load is a fixed number of concurrent clients that send
+their next request as soon as the previous one returns (--concurrency), or a
+fixed arrival rate that sends requests on schedule whether or not the earlier
+ones have returned (--rate). With a fixed rate the latency is counted from the
+time a request was due, so a stalled server is not hidden by requests that
+could not be sent.
+
+    python -m benchmarks.http_load --concurrency 32 --duration 30
+    python -m benchmarks.http_load --url http://127.0.0.1:8000 --rate 500 --mix post=1,getbytime=4
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+USERS = ["jdoe", "jp", "jm", "jl", "abk", "zk", "ank", "ll"]
+EQUIPMENT = ["ore scooper", "multi-phasic radiation scanner", "1.21 gigawatt lightning harvester"]
+DEFAULT_MIX = "post=2,cancel=1,getbytime=3,getbyuser=2,getbyequip=2"
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def parse_mix(spec: str) -> dict:
+    """Parses "name=weight,name=weight" into {name: weight}"""
+
+    mix = {}
+    for pair in spec.split(","):
+        name, weight = pair.split("=")
+        if name not in REQUESTS:
+            raise ValueError(f"Unknown request '{name}', choose from {', '.join(REQUESTS)}")
+        mix[name] = float(weight)
+    return mix
+
+
+class Workload:
+    """Builds the requests of a run
+
+    Parameters
+    ----------
+    mix: dict
+        - The relative weight of every request kind
+    seed: int
+        - Seed of the random choices, so two runs send the same requests
+    cancel_ids: list
+        - Ids of active reservations the cancel requests use up"""
+
+    def __init__(self, mix: dict, seed: int, cancel_ids: list):
+        self.rng = random.Random(seed)
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.cancel_ids = cancel_ids
+        self.max_id = max(cancel_ids, default=1)
+        self.first_day = datetime.datetime.now().replace(minute=0, second=0, microsecond=0) + datetime.timedelta(days=30)
+
+    def next(self) -> tuple:
+        """Returns the kind, method, path and httpx arguments of the next request"""
+
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        return (kind,) + REQUESTS[kind](self)
+
+    def window(self, hours: int) -> tuple:
+        start = self.first_day + datetime.timedelta(hours=self.rng.randrange(24 * 365))
+        return start.strftime(DATE_FORMAT), (start + datetime.timedelta(hours=hours)).strftime(DATE_FORMAT)
+
+    def post(self) -> tuple:
+        start, end = self.window(1)
+        return "POST", "/reservation/post", {"json": {
+            "user_name": self.rng.choice(USERS), "equipment_name": self.rng.choice(EQUIPMENT),
+            "start_time": start, "end_time": end,
+            "x_coor": str(self.rng.randint(1, 20)), "y_coor": str(self.rng.randint(1, 20))}}
+
+    def cancel(self) -> tuple:
+        # once the known reservations are used up, cancels are refused by the service
+        reservation_id = self.cancel_ids.pop() if self.cancel_ids else self.rng.randint(1, self.max_id)
+        return "DELETE", "/reservation/cancel", {"params": {"id": reservation_id}}
+
+    def getbytime(self) -> tuple:
+        start, end = self.window(24 * 7)
+        return "GET", "/reservation/getbytime", {"params": {"start": start, "end": end}}
+
+    def getbyuser(self) -> tuple:
+        start, end = self.window(24 * 30)
+        return "GET", "/reservation/getbyuser", {"params": {"user_name": self.rng.choice(USERS),
+                                                            "start": start, "end": end}}
+
+    def getbyequip(self) -> tuple:
+        start, end = self.window(24 * 7)
+        return "GET", "/reservation/getbyequip", {"params": {"equipment_name": self.rng.choice(EQUIPMENT),
+                                                             "start": start, "end": end}}
+
+    def getall(self) -> tuple:
+        return "GET", "/reservation/getall", {"params": {"limit": 100}}
+
+
+REQUESTS = {"post": Workload.post, "cancel": Workload.cancel, "getbytime": Workload.getbytime,
+            "getbyuser": Workload.getbyuser, "getbyequip": Workload.getbyequip, "getall": Workload.getall}
+
+
+class Recorder:
+    """Collects the outcome of every request by kind"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.rejected = {}
+
+    def record(self, kind: str, seconds: float, error: bool, rejected: bool) -> None:
+        self.latencies.setdefault(kind, []).append(seconds)
+        self.errors[kind] = self.errors.get(kind, 0) + error
+        self.rejected[kind] = self.rejected.get(kind, 0) + rejected
+
+    def report(self, elapsed: float) -> dict:
+        """Summarises the run, per kind and in total"""
+
+        kinds = {kind: summarize(latencies, self.errors[kind], self.rejected[kind], elapsed)
+                 for kind, latencies in sorted(self.latencies.items())}
+        everything = [seconds for latencies in self.latencies.values() for seconds in latencies]
+        total = summarize(everything, sum(self.errors.values()), sum(self.rejected.values()), elapsed)
+        return {"total": total, "endpoints": kinds}
+
+
+def percentile(ordered: list, share: float) -> float:
+    """Nearest rank percentile of a sorted list"""
+
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(share * len(ordered) + 0.5) - 1))]
+
+
+def summarize(latencies: list, errors: int, rejected: int, elapsed: float) -> dict:
+    """Throughput, latency percentiles in milliseconds, error and rejection rates of a set of requests
+
+    Errors are transport failures and HTTP error statuses; rejections are answers
+    with "success": false, such as a booking refused for lack of capacity."""
+
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {"requests": count, "throughput": round(count / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+            "error_rate": round(errors / count, 4) if count else 0.0,
+            "rejected_rate": round(rejected / count, 4) if count else 0.0}
+
+
+async def send(client: httpx.AsyncClient, workload: Workload, recorder: Recorder, due: float = None) -> None:
+    """Sends the next request of the workload and records it, from `due` if given"""
+
+    kind, method, path, kwargs = workload.next()
+    start = time.perf_counter() if due is None else due
+    error = rejected = False
+    try:
+        response = await client.request(method, path, **kwargs)
+        error = response.status_code >= 400
+        if not error and response.headers.get("content-type", "").startswith("application/json"):
+            rejected = response.json().get("success") is False
+    except httpx.HTTPError:
+        error = True
+    recorder.record(kind, time.perf_counter() - start, error, rejected)
+
+
+async def closed_loop(client, workload, recorder, concurrency: int, duration: float) -> None:
+    """`concurrency` clients each send their next request when the last one returns"""
+
+    deadline = time.perf_counter() + duration
+
+    async def client_loop():
+        while time.perf_counter() < deadline:
+            await send(client, workload, recorder)
+
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+
+
+async def open_loop(client, workload, recorder, rate: float, duration: float) -> None:
+    """Requests are sent `rate` times a second, whether or not the earlier ones returned"""
+
+    start = time.perf_counter()
+    tasks = set()
+    for i in range(int(rate * duration)):
+        due = start + i / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.ensure_future(send(client, workload, recorder, due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+
+
+async def active_ids(client: httpx.AsyncClient, count: int = 10000) -> list:
+    """Ids of active reservations for the cancel requests to use"""
+
+    response = await client.get("/reservation/getall", params={"limit": count})
+    reservations = response.json()["message"]["reservations"]
+    return [reservation["reservation_id"] for reservation in reservations if reservation["active"]]
+
+
+async def run(args) -> dict:
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout,
+                                   limits=httpx.Limits(max_connections=None))
+        service = None
+    else:
+        # the service creates and migrates reservation_system.db in the working directory
+        os.chdir(args.workdir or tempfile.mkdtemp(prefix="http_load_"))
+        sys.path.insert(0, ROOT)
+        import api_service as service
+        # an exception in the app comes back as a 500 and is counted, as it would be over http
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=service.app, raise_app_exceptions=False),
+                                   base_url="http://benchmark", timeout=args.timeout)
+
+    try:
+        async with client:
+            workload = Workload(parse_mix(args.mix), args.seed, await active_ids(client))
+            recorder = Recorder()
+            start = time.perf_counter()
+            if args.rate:
+                await open_loop(client, workload, recorder, args.rate, args.duration)
+            else:
+                await closed_loop(client, workload, recorder, args.concurrency, args.duration)
+            elapsed = time.perf_counter() - start
+    finally:
+        if service is not None:
+            await service.sys.db.close()
+
+    report = recorder.report(elapsed)
+    report["config"] = {"target": args.url or "in-process", "mix": args.mix, "seed": args.seed,
+                        "duration": args.duration, "elapsed": round(elapsed, 3),
+                        "mode": f"rate={args.rate}" if args.rate else f"concurrency={args.concurrency}"}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", help="base url of a running server, in process when omitted")
+    parser.add_argument("--workdir", help="directory of the in process database, a new temporary one when omitted")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"request weights, default {DEFAULT_MIX}")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients, closed loop")
+    parser.add_argument("--rate", type=float, help="requests per second, open loop instead of --concurrency")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds before a request counts as failed")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the request choices")
+    parser.add_argument("--output", help="file to write the report to, stdout when omitted")
+    args = parser.parse_args(argv)
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
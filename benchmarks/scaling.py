@@ -0,0 +1,201 @@
+"""Scaling benchmark of the ReservationSystem methods
+
+Seeds a reservation system with each of the given numbers of reservations and
+times the same calls at every size, then prints one row per method with the
+median milliseconds per size and the growth exponent k of time ~ n^k between
+the smallest and largest size: k near 0 is independent of the history, k near 1
+grows linearly with it.
+
+Both systems are measured: the database backed server.res_system.ReservationSystem
+(in a temporary directory, bulk loaded with executemany and the interval index
+rebuilt) and the in-memory res_system.ReservationSystem.
+
+    python -m benchmarks.scaling --sizes 1000,10000,100000,1000000 --repeat 5
+    python -m benchmarks.scaling --system memory --json scaling.json
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from server.db_utils import to_epoch  # noqa: E402
+
+USERS = ["jdoe", "jp", "jm", "jl", "abk", "zk", "ank", "ll"]
+EQUIPMENT = ["ore scooper", "multi-phasic radiation scanner", "1.21 gigawatt lightning harvester"]
+# the seeded history is spread hour by hour from here, the timed bookings go after it
+HISTORY_START = datetime.datetime(2020, 1, 1)
+
+
+def history(size: int, rng: random.Random):
+    """Yields (username, equipment, start, end) of `size` reservations of one to four hours"""
+
+    for i in range(size):
+        start = HISTORY_START + datetime.timedelta(minutes=30 * i + rng.randrange(30))
+        yield (rng.choice(USERS), rng.choice(EQUIPMENT), start,
+               start + datetime.timedelta(hours=rng.randint(1, 4)))
+
+
+def window(size: int, rng: random.Random, hours: int) -> tuple:
+    """A time range of `hours` somewhere in the seeded history"""
+
+    start = HISTORY_START + datetime.timedelta(minutes=30 * rng.randrange(max(size, 1)))
+    return start, start + datetime.timedelta(hours=hours)
+
+
+def seed_server(size: int, rng: random.Random):
+    """A server.res_system.ReservationSystem on a new database holding `size` reservations"""
+
+    from server.res_system import ReservationSystem
+
+    os.chdir(tempfile.mkdtemp(prefix="scaling_"))
+    system = ReservationSystem()
+    first_id = system.db.select("reservations", "coalesce(max(reservation_id), 0) + 1")[0][0]
+    rows = [(user, equipment, to_epoch(start), to_epoch(end), 100.0, 50.0, "1 1")
+            for user, equipment, start, end in history(size, rng)]
+    system.db.add_reservations(rows)
+    system.index.load(system.db.active_intervals())
+    return system, first_id
+
+
+def seed_memory(size: int, rng: random.Random):
+    """An in-memory res_system.ReservationSystem holding `size` reservations
+
+    The reservations are appended directly, make_reservation would check each
+    one against all the earlier ones."""
+
+    import res_system
+
+    system = res_system.ReservationSystem()
+    equipment = {item.name: item for item in system.equipment_list}
+    first_id = system.reservation_id_counter
+    for user, name, start, end in history(size, rng):
+        system.reservations.append(res_system.Reservation(system.reservation_id_counter, user, equipment[name],
+                                                          start, end, 100.0, 50.0, 1, 1))
+        system.reservation_id_counter += 1
+    return system, first_id
+
+
+def calls(kind: str, system, size: int, first_id: int, rng: random.Random) -> dict:
+    """The calls to time, by name; each builds its arguments afresh so every repeat does new work"""
+
+    # bookings go after the history, an hour apart, so they are always available
+    slot = iter(range(10 ** 9))
+    after = HISTORY_START + datetime.timedelta(minutes=30 * size + 24 * 60)
+    # cancellations use up distinct seeded reservations
+    cancel_ids = iter(rng.sample(range(first_id, first_id + size), min(size, 1000)))
+
+    def booking():
+        start = after + datetime.timedelta(hours=next(slot))
+        return start, start + datetime.timedelta(hours=1)
+
+    if kind == "server":
+        timed = {
+            "make_reservation": lambda: system.make_reservation("jdoe", "ore scooper", *booking(), "1", "1"),
+            "_check_availability": lambda: system._check_availability(
+                "multi-phasic radiation scanner", *window(size, rng, 2)),
+            "cancel_reservation": lambda: system.cancel_reservation(next(cancel_ids)),
+            "list_reservations": lambda: system.list_reservations(*window(size, rng, 24)),
+            "list_customer_reservations": lambda: system.list_customer_reservations(
+                rng.choice(USERS), *window(size, rng, 24 * 7)),
+            "list_machine_reservations": lambda: system.list_machine_reservations(
+                rng.choice(EQUIPMENT), *window(size, rng, 24)),
+            "list_all_reservations": lambda: system.list_all_reservations(),
+            "list_all_reservations(limit=100)": lambda: system.list_all_reservations(100),
+        }
+    else:
+        scanner = system._find_equipment("multi-phasic radiation scanner")
+        timed = {
+            "make_reservation": lambda: system.make_reservation("jdoe", "ore scooper", *booking(), 1, 1),
+            "_check_availability": lambda: system._check_availability(scanner, *window(size, rng, 2)),
+            "cancel_reservation": lambda: system.cancel_reservation(next(cancel_ids)),
+            "list_reservations": lambda: system.list_reservations(*window(size, rng, 24)),
+            "list_customer_reservations": lambda: system.list_customer_reservations(
+                rng.choice(USERS), *window(size, rng, 24 * 7)),
+            "list_machine_reservations": lambda: system.list_machine_reservations(
+                rng.choice(EQUIPMENT), *window(size, rng, 24)),
+            "list_all_reservations": lambda: system.list_all_reservations(),
+        }
+    return timed
+
+
+def measure(kind: str, size: int, repeat: int, seed: int) -> dict:
+    """Median seconds of every call at one size"""
+
+    rng = random.Random(seed)
+    system, first_id = (seed_server if kind == "server" else seed_memory)(size, rng)
+    results = {}
+    try:
+        for name, call in calls(kind, system, size, first_id, rng).items():
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                call()
+                samples.append(time.perf_counter() - start)
+            results[name] = statistics.median(samples)
+    finally:
+        if kind == "server":
+            system.db.close()
+    return results
+
+
+def growth(sizes: list, seconds: list) -> float:
+    """The exponent k of seconds ~ size^k between the smallest and the largest size"""
+
+    if len(sizes) < 2 or min(seconds[0], seconds[-1]) <= 0:
+        return float("nan")
+    return math.log(seconds[-1] / seconds[0]) / math.log(sizes[-1] / sizes[0])
+
+
+def table(kind: str, sizes: list, results: dict) -> str:
+    """Formats the medians in milliseconds, one row per method"""
+
+    names = list(results[sizes[0]])
+    width = max(len(name) for name in names) + 2
+    lines = [f"{kind} ReservationSystem, median ms",
+             "method".ljust(width) + "".join(f"{size:>12,}" for size in sizes) + f"{'k':>8}"]
+    for name in names:
+        seconds = [results[size][name] for size in sizes]
+        lines.append(name.ljust(width) + "".join(f"{s * 1000:>12.3f}" for s in seconds)
+                     + f"{growth(sizes, seconds):>8.2f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma separated numbers of seeded reservations")
+    parser.add_argument("--system", choices=("server", "memory", "both"), default="both")
+    parser.add_argument("--repeat", type=int, default=5, help="calls per method and size, the median is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="file to write the medians to, in seconds")
+    args = parser.parse_args(argv)
+
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+    # the server system runs in temporary directories
+    output = os.path.abspath(args.json) if args.json else None
+    kinds = ["server", "memory"] if args.system == "both" else [args.system]
+    report = {}
+    for kind in kinds:
+        results = {size: measure(kind, size, args.repeat, args.seed) for size in sizes}
+        print(table(kind, sizes, results) + "\n")
+        report[kind] = {name: {"seconds": {size: results[size][name] for size in sizes},
+                               "k": growth(sizes, [results[size][name] for size in sizes])}
+                        for name in results[sizes[0]]}
+
+    if output:
+        with open(output, "w") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,22 @@ class ReservationSystem:
                 print(res_id, "/", user_name, "/", first_name,"/",equip, "/", start_time, "/", end_time, "/", total_cost, "/",
                       down_payment, "/", location)
 
+    def get_all_pages(self, endpoint, payload=""):
+        """
+        call a paged list endpoint and follow next_cursor until the last page,
+        returning one json with the reservations of every page
+        """
+        r = requests.get(self.url + endpoint + payload)
+        r_json = r.json()
+        while r.status_code == 200 and r_json["success"] and r_json["message"]["next_cursor"] is not None:
+            r = requests.get(self.url + endpoint + payload, params={"cursor": r_json["message"]["next_cursor"]})
+            page = r.json()
+            if not page["success"]:
+                break
+            r_json["message"]["reservations"] += page["message"]["reservations"]
+            r_json["message"]["next_cursor"] = page["message"]["next_cursor"]
+        return r_json
+
     def check_username(self, username):
         r = requests.get(self.url + "user?username=" + username)
         r_json = r.json()
@@ -272,14 +288,13 @@ class ReservationSystem:
         if self.user_role == "customer":
             # make http get request
             payload = f"?start='{start_time}'&end='{end_time}'&user_name='{self.user_name}'"
-            r = requests.get(self.url + "getbyuser" + payload)
+            r_json = self.get_all_pages("getbyuser", payload)
         else:
             # make the http get request with query parameters
             params = f"?start='{start_time}'&end='{end_time}'"
-            r = requests.get(self.url + "getbytime" + params)
+            r_json = self.get_all_pages("getbytime", params)
 
         # parse and print the results
-        r_json = r.json()
         if r_json["success"]:
             self.print_reservations_from_json(r_json)
         else:
@@ -304,10 +319,9 @@ class ReservationSystem:
 
         # make http get request
         payload = f"?start='{start_time}'&end='{end_time}'&user_name='{name}'"
-        r = requests.get(self.url + "getbyuser" + payload)
+        r_json = self.get_all_pages("getbyuser", payload)
 
         # parse and print the results
-        r_json = r.json()
         if r_json["success"]:
             self.print_reservations_from_json(r_json)
         else:
@@ -342,10 +356,9 @@ class ReservationSystem:
 
         # make http get request
         payload = f"?start='{start_time}'&end='{end_time}'&equipment_name='{machine_name}'&user_name='{name}'"
-        r = requests.get(self.url + "getbyequip" + payload)
+        r_json = self.get_all_pages("getbyequip", payload)
 
         # parse and print the results
-        r_json = r.json()
         if r_json["success"]:
             self.print_reservations_from_json(r_json)
         else:
@@ -354,9 +367,9 @@ class ReservationSystem:
 
     def print_all_reservations(self):
         print("Printing the reservations...")
-        r = requests.get(self.url + "getall")
-        if r.status_code == 200:
-            self.print_reservations_from_json(r.json())
+        r_json = self.get_all_pages("getall")
+        if r_json["success"]:
+            self.print_reservations_from_json(r_json)
         else:
             print("Can not print reservations, please try again later")
 
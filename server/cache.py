@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+from server.settings import CATALOG_MAX_AGE, IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL
+
+
+class EquipmentCatalog:
+    """In-process copy of the machines table
+
+    Maps equipment name to its (available, cost) pair. The catalog is tiny and
+    almost never changes, so it is loaded once and then served from a dict. It
+    is marked stale by invalidate(), called whenever the machines table is
+    written, and at the latest after `max_age` seconds so that edits made
+    outside this process are picked up as well. The owner checks stale() and
+    refills it with fill(), which keeps the catalog usable from both the sync
+    and the async reservation systems."""
+
+    def __init__(self, max_age=CATALOG_MAX_AGE):
+        self.max_age = max_age
+        self.machines = {}
+        self.loaded_at = None
+
+    def stale(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age
+
+    def fill(self, rows: list) -> dict:
+        """Replaces the catalog with (equipment, available, cost) rows"""
+
+        self.machines = {equipment: (available, cost) for equipment, available, cost in rows}
+        self.loaded_at = time.monotonic()
+        return self.machines
+
+    def invalidate(self) -> None:
+        self.loaded_at = None
+
+
+class TTLCache:
+    """Bounded least recently used cache whose entries expire after `ttl` seconds
+
+    get returns None for a missing or expired key, so None itself cannot be
+    cached; store an empty value to remember that something does not exist."""
+
+    def __init__(self, max_size=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if time.monotonic() > expires_at:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
@@ -0,0 +1,116 @@
+import logging
+import os
+import re
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where only one worker process is supported
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+# databases created before migrations existed already hold the schema and seed data
+BASELINE_VERSION = 2
+
+CREATE_SCHEMA_VERSION = """CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR,
+    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+)"""
+
+
+class MigrationRunner:
+    """Brings the database schema up to date
+
+    Migrations are the NNNN_description.sql files in server/migrations and are
+    applied in order of their number. The schema_version table records the ones
+    that ran, so each migration is applied exactly once and starting the
+    service only pays for the pending ones.
+
+    Several worker processes may start on the same database at once. The first
+    to take the lock file next to it is the leader and applies the migrations;
+    the others wait for the lock, then find nothing pending."""
+
+    def __init__(self, db, migrations_dir=MIGRATIONS_DIR):
+        self.db = db
+        self.migrations_dir = migrations_dir
+
+    def migrations(self) -> list:
+        """Returns (version, name, path) for every migration file, in order"""
+
+        migrations = []
+        for file_name in os.listdir(self.migrations_dir):
+            match = re.fullmatch(r"(\d+)_(\w+)\.sql", file_name)
+            if match:
+                migrations.append((int(match.group(1)), match.group(2),
+                                   os.path.join(self.migrations_dir, file_name)))
+        return sorted(migrations)
+
+    def applied(self) -> set:
+        """Returns the versions already applied to the database"""
+
+        return {row[0] for row in self.db.select("schema_version", "version")}
+
+    def pending(self) -> list:
+        applied = self.applied()
+        return [migration for migration in self.migrations() if migration[0] not in applied]
+
+    def run(self) -> list:
+        """Applies the pending migrations and returns their versions"""
+
+        with self._leader_lock():
+            self._adopt_existing_database()
+
+            done = []
+            for version, name, path in self.pending():
+                logger.info("Applying migration %s %s", version, name)
+                self._apply(version, name, path)
+                done.append(version)
+        return done
+
+    @contextmanager
+    def _leader_lock(self):
+        """Holds an exclusive lock on <database>.lock, so one process migrates at a time"""
+
+        if fcntl is None:
+            yield
+            return
+
+        with open(f"{self.db.db_name}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _adopt_existing_database(self) -> None:
+        """Creates schema_version, marking the baseline migrations as applied when
+        the tables were created by the old drop and reseed start up"""
+
+        existing = self.db.select("sqlite_master", "name", "type = 'table' AND name IN (?, ?)",
+                                  ("reservations", "schema_version"))
+        existing = {row[0] for row in existing}
+
+        self.db.execute_query(CREATE_SCHEMA_VERSION)
+        if existing == {"reservations"}:
+            for version, name, _ in self.migrations():
+                if version <= BASELINE_VERSION:
+                    self.db.insert("schema_version", "version, name", "?, ?", (version, name))
+
+    def _apply(self, version: int, name: str, path: str) -> None:
+        """Runs one migration and records it in a single transaction"""
+
+        with open(path, 'r') as sql_script:
+            script = sql_script.read()
+
+        with self.db.writer() as cursor:
+            try:
+                cursor.executescript(f"BEGIN IMMEDIATE;\n{script}\n;\n"
+                                     f"INSERT INTO schema_version (version, name) VALUES ({version}, '{name}');\n"
+                                     "COMMIT;")
+            except Exception:
+                if self.db.conn.in_transaction:
+                    self.db.conn.rollback()
+                raise
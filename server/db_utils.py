@@ -1,136 +1,839 @@
+import asyncio
+import calendar
 import sqlite3
 import aiosqlite
 import datetime
+import itertools
 import logging
+import queue
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from server.executor import BoundedExecutor
+from server.metrics import CONNECTION_WAIT, QUERY_LATENCY, statement
+from server.profiler import QueryProfiler
+from server.settings import (BUSY_BACKOFF, BUSY_RETRIES, BUSY_TIMEOUT, EXECUTOR_QUEUE_DEPTH, EXECUTOR_READ_WORKERS, EXECUTOR_TIMEOUT,
+                             EXECUTOR_WRITE_WORKERS, GROUP_COMMIT, GROUP_COMMIT_INTERVAL, GROUP_COMMIT_MAX_BATCH,
+                             PROFILE_QUERIES, READER_POOL_SIZE, STREAM_FETCH_SIZE)
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
+# one record per query, sampled, see server.logs
+query_logger = logging.getLogger(__name__ + ".queries")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# reservation times are stored as integer seconds since the epoch, in UTC
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def to_epoch(date_time: datetime.datetime) -> int:
+    """Converts a naive datetime to the integer seconds stored in the database"""
+    return calendar.timegm(date_time.timetuple())
+
+
+def from_epoch(seconds: int) -> datetime.datetime:
+    """Converts stored integer seconds back to a naive datetime"""
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def format_epoch(seconds: int) -> str:
+    """Formats stored integer seconds the way the api has always shown dates"""
+    return time.strftime(DATETIME_FORMAT, time.gmtime(seconds))
+
+
+# prepared statements kept per connection, comfortably above the number of templates
+STATEMENT_CACHE_SIZE = 256
+
+# Statement templates. Values are always bound as parameters, so the text of a
+# statement never changes between calls and sqlite3 reuses the prepared
+# statement from its per connection cache instead of parsing it again.
+INSERT_RESERVATION = """INSERT INTO reservations (username, equipment, start_date, end_date, active, cost, downpayment, location)
+    VALUES (?, ?, ?, ?, TRUE, ?, ?, ?)"""
+SELECT_ACTIVE_RESERVATIONS = "SELECT * FROM reservations WHERE active = TRUE"
+# only an active reservation is cancelled, so of two concurrent cancels of the same id one gets the row
+CANCEL_RESERVATION = """UPDATE reservations SET active = FALSE WHERE reservation_id = ? AND active = TRUE
+    RETURNING equipment, start_date, end_date, downpayment"""
+# the condition is put together by ReservationSystem.cancel_reservations from fixed fragments
+CANCEL_RESERVATIONS = """UPDATE reservations SET active = FALSE WHERE active = TRUE AND {condition}
+    RETURNING reservation_id, equipment, start_date, end_date, downpayment"""
+SELECT_RESERVATION = "SELECT * FROM reservations WHERE reservation_id = ?"
+SELECT_RESERVATIONS_BETWEEN = "SELECT * FROM reservations WHERE start_date >= ? AND end_date <= ?"
+DEACTIVATE_USER = "UPDATE users SET active = FALSE WHERE username = ?"
+INSERT_USER = "INSERT INTO users (username, first_name, active) VALUES (?, ?, 'TRUE')"
+SELECT_USER_ID = "SELECT user_id FROM users WHERE username = ?"
+SELECT_ROLE_ID = "SELECT role_id FROM roles WHERE role = ?"
+INSERT_USER_ROLE = "INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)"
+UPDATE_USER_ROLE = "UPDATE user_roles SET role_id = ? WHERE user_id = ?"
+SELECT_FIRST_NAME = "SELECT first_name FROM users WHERE username = ? and active = 'TRUE'"
+SELECT_IDENTITY = """SELECT u.user_id, u.username, u.first_name, u.active, r.role
+    FROM users u
+    LEFT JOIN user_roles ur ON u.user_id = ur.user_id
+    LEFT JOIN roles r ON ur.role_id = r.role_id
+    WHERE u.username = ?"""
+SELECT_MACHINES = "SELECT equipment, available, cost FROM machines"
+SELECT_ACTIVE_INTERVALS = "SELECT equipment, start_date, end_date FROM reservations WHERE active = TRUE"
+SELECT_LAST_CHANGE = "SELECT coalesce(max(change_id), 0) FROM reservation_changes"
+SELECT_CHANGES_SINCE = """SELECT change_id, equipment, start_date, end_date, delta FROM reservation_changes
+    WHERE change_id > ? ORDER BY change_id"""
+LAST_INSERT_ID = "SELECT last_insert_rowid()"
+# the triggers that write the reservation_changes log, only in place with SHARED_DB, see DBUtils.track_changes
+CHANGE_TRIGGERS = {
+    "reservations_booked": """CREATE TRIGGER IF NOT EXISTS reservations_booked AFTER INSERT ON reservations
+    WHEN NEW.active
+BEGIN
+    INSERT INTO reservation_changes (reservation_id, equipment, start_date, end_date, delta)
+        VALUES (NEW.reservation_id, NEW.equipment, NEW.start_date, NEW.end_date, 1);
+END""",
+    "reservations_cancelled": """CREATE TRIGGER IF NOT EXISTS reservations_cancelled AFTER UPDATE OF active ON reservations
+    WHEN OLD.active AND NOT NEW.active
+BEGIN
+    INSERT INTO reservation_changes (reservation_id, equipment, start_date, end_date, delta)
+        VALUES (NEW.reservation_id, NEW.equipment, NEW.start_date, NEW.end_date, -1);
+END""",
+    # the log keeps the last 100000 changes, a worker that fell further behind reloads its index
+    "reservation_changes_pruned": """CREATE TRIGGER IF NOT EXISTS reservation_changes_pruned
+    AFTER INSERT ON reservation_changes WHEN NEW.change_id % 1000 = 0
+BEGIN
+    DELETE FROM reservation_changes WHERE change_id <= NEW.change_id - 100000;
+END""",
+}
+SELECT_CHANGE_TRIGGERS = "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN ({})".format(
+    ", ".join(f"'{name}'" for name in CHANGE_TRIGGERS))
+
+
+def connect(db_name, **kwargs):
+    """Opens a sqlite3 connection configured for WAL
+
+    In WAL mode readers see the last committed state and never wait on the
+    writer, so the read pool and the writer can work at the same time."""
+
+    conn = sqlite3.connect(db_name, check_same_thread=False, timeout=BUSY_TIMEOUT,
+                           cached_statements=STATEMENT_CACHE_SIZE, **kwargs)
+    conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+
+def is_busy(error: sqlite3.Error) -> bool:
+    """Whether an error means another connection held the lock a statement needed"""
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(error)
+
+
+def backoff(attempt: int) -> float:
+    """Seconds to wait before retrying a busy write, doubled on every attempt and
+    jittered so the workers that collided do not retry in step"""
+    return BUSY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
+class GroupCommitter:
+    """Commits writes from many callers together in one transaction
+
+    Writes are queued with submit, which returns a Future. A background thread
+    takes the first queued write, waits up to `interval` seconds (or until
+    `max_batch` writes are queued) for more, runs them all inside one
+    transaction and commits once. Every future is resolved only after that
+    commit returns, so a caller never sees success for a write that is not
+    durable, while the cost of the commit is shared by the whole group.
+    A future resolves to the rowid of the last row its write inserted.
+
+    Each write runs inside its own savepoint, so a failing statement is rolled
+    back and reported to its caller alone, without failing the rest."""
+
+    def __init__(self, db_name, interval=GROUP_COMMIT_INTERVAL, max_batch=GROUP_COMMIT_MAX_BATCH):
+        # autocommit mode, the transaction is managed by hand in _flush
+        self.conn = connect(db_name, isolation_level=None)
+        self.interval = interval
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self.thread.start()
+
+    def submit(self, query, params=(), many=False) -> Future:
+        """Queues a write, `many` runs it with executemany over `params`"""
+        future = Future()
+        self.pending.put((query, params, many, future, time.perf_counter()))
+        return future
+
+    def _run(self):
+        while True:
+            write = self.pending.get()
+            if write is None:
+                return
+
+            batch = [write]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch:
+                try:
+                    write = self.pending.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if write is None:
+                    # flush what we have, then stop
+                    self.pending.put(None)
+                    break
+                batch.append(write)
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        cursor = self.conn.cursor()
+        written = []
+
+        started = time.perf_counter()
+        for _, _, _, _, submitted in batch:
+            CONNECTION_WAIT.observe(started - submitted, "group_commit")
+
+        try:
+            # other processes may hold the database, wait for it before writing anything
+            for attempt in itertools.count():
+                try:
+                    cursor.execute("BEGIN IMMEDIATE")
+                    break
+                except sqlite3.OperationalError as e:
+                    if not is_busy(e) or attempt >= BUSY_RETRIES:
+                        raise
+                time.sleep(backoff(attempt))
+
+            for query, params, many, future, _ in batch:
+                cursor.execute("SAVEPOINT write")
+                try:
+                    if many:
+                        cursor.executemany(query, params)
+                        row_id = cursor.execute(LAST_INSERT_ID).fetchone()[0]
+                    else:
+                        row_id = cursor.execute(query, params).lastrowid
+                except sqlite3.Error as e:
+                    cursor.execute("ROLLBACK TO write")
+                    future.set_exception(e)
+                else:
+                    written.append((future, row_id))
+                cursor.execute("RELEASE write")
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            for future, _ in written:
+                future.set_exception(e)
+            # the writes that were never tried fail with the transaction
+            for _, _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, row_id in written:
+            future.set_result(row_id)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self.conn.close()
 
 
 class DBUtils:
-    def __init__(self, db_name):
+    """Thin query layer over a pool of sqlite3 connections
+
+    There is one writer connection, guarded by a lock, and a pool of reader
+    connections that are checked out per query. Every connection has its own
+    cursor, so threads never share one. With `group_commit` the writes go
+    through a GroupCommitter instead of committing one by one. With `profile`
+    every query is also recorded by a QueryProfiler, see `timed`.
+
+    The writer begins its transactions with BEGIN IMMEDIATE, so with several
+    processes on one database a write waits for the database lock before it
+    reads anything, and is retried with backoff if it cannot get it."""
+
+    def __init__(self, db_name, readers=READER_POOL_SIZE, group_commit=GROUP_COMMIT, profile=PROFILE_QUERIES):
         self.db_name = db_name
-        self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
+        self.conn = connect(self.db_name, isolation_level="IMMEDIATE")
         self.cursor = self.conn.cursor()
+        self.write_lock = threading.RLock()
+        self.committer = GroupCommitter(self.db_name) if group_commit else None
+        self.profiler = QueryProfiler() if profile else None
+
+        self.readers = queue.Queue()
+        self.reader_conns = []
+        for _ in range(readers):
+            conn = connect(self.db_name)
+            self.reader_conns.append(conn)
+            self.readers.put(conn.cursor())
+
+    @contextmanager
+    def writer(self):
+        """Yields the writer cursor, holding the write lock"""
+        start = time.perf_counter()
+        with self.write_lock:
+            CONNECTION_WAIT.observe(time.perf_counter() - start, "writer")
+            yield self.cursor
+
+    @contextmanager
+    def reader(self):
+        """Checks a reader cursor out of the pool and returns it afterwards"""
+        start = time.perf_counter()
+        cursor = self.readers.get()
+        CONNECTION_WAIT.observe(time.perf_counter() - start, "reader")
+        try:
+            yield cursor
+        finally:
+            self.readers.put(cursor)
+
+    @contextmanager
+    def timed(self, query, params=()):
+        """Times the with block as one run of `query`, for the metrics and the profiler
+
+        A slow query is logged with its plan; the plan is explained on the
+        writer connection, since the caller may hold the only free reader."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            QUERY_LATENCY.observe(seconds, statement(query))
+            if self.profiler is not None and self.profiler.record(query, seconds):
+                plan = None
+                if self.profiler.needs_plan(query):
+                    try:
+                        with self.writer() as cursor:
+                            plan = cursor.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+                    except sqlite3.Error as e:
+                        logger.info("Could not explain %s: %s", statement(query), e)
+                self.profiler.log_slow(query, seconds, plan)
 
     def create_table(self, table_name, columns):
         query = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})"
-        self.cursor.execute(query)
-        self.conn.commit()
+        self.execute_query(query)
 
-    def insert(self, table_name, columns, values):
+    # The generic helpers below only interpolate table names, column lists and
+    # conditions written in the code; values go in `params` and are bound.
+    def insert(self, table_name, columns, values, params=()):
         query = f"INSERT INTO {table_name} ({columns}) VALUES ({values})"
-        self.cursor.execute(query)
-        self.conn.commit()
+        self.execute_query(query, params)
 
-    def select(self, table_name, columns, condition='1=1'):
+    def select(self, table_name, columns, condition='1=1', params=()):
         query = f"SELECT {columns} FROM {table_name} WHERE {condition}"
 
-        logger.debug(f"Executing query {query}")
+        query_logger.debug("select", extra={"query": query})
 
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+        return self.execute_query_with_return(query, params)
+
+    def select_iter(self, table_name, columns, condition='1=1', params=()):
+        query = f"SELECT {columns} FROM {table_name} WHERE {condition}"
+        return self.iterate_query(query, params)
 
-    def update(self, table_name, columns, condition):
+    def update(self, table_name, columns, condition, params=()):
         query = f"UPDATE {table_name} SET {columns} WHERE {condition}"
-        self.cursor.execute(query)
-        self.conn.commit()
+        self.execute_query(query, params)
 
-    def delete(self, table_name, condition):
+    def delete(self, table_name, condition, params=()):
         query = f"DELETE FROM {table_name} WHERE {condition}"
-        self.cursor.execute(query)
-        self.conn.commit()
+        self.execute_query(query, params)
 
-    def execute_query(self, query):
-        self.cursor.execute(query)
-        self.conn.commit()
+    def _transaction(self, write):
+        """Runs write(cursor) on the writer and commits, returning what write returned
 
-    def execute_query_with_return(self, query):
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+        A write that finds the database locked by another process past BUSY_TIMEOUT
+        is rolled back and tried again, up to BUSY_RETRIES times with backoff."""
+        for attempt in itertools.count():
+            with self.writer() as cursor:
+                try:
+                    result = write(cursor)
+                    self.conn.commit()
+                    return result
+                except sqlite3.OperationalError as e:
+                    if self.conn.in_transaction:
+                        self.conn.rollback()
+                    if not is_busy(e) or attempt >= BUSY_RETRIES:
+                        raise
+            time.sleep(backoff(attempt))
+
+    def execute_query(self, query, params=()):
+        """Runs a write and returns the rowid of the row it inserted, if any"""
+        if self.committer:
+            # blocks until the group holding this write has committed
+            with self.timed(query, params):
+                return self.committer.submit(query, params).result()
+
+        with self.timed(query, params):
+            return self._transaction(lambda cursor: cursor.execute(query, params).lastrowid)
+
+    def execute_write_with_return(self, query, params=()):
+        """Runs a write with a RETURNING clause in its own transaction and returns the rows
+
+        It always goes to the writer, past the group committer, whose futures
+        only carry a rowid."""
+        with self.timed(query, params):
+            return self._transaction(lambda cursor: cursor.execute(query, params).fetchall())
+
+    def execute_query_with_return(self, query, params=()):
+        with self.reader() as cursor, self.timed(query, params):
+            cursor.execute(query, params)
+            return cursor.fetchall()
     
-    def execute_query_with_return_one(self, query):
-        self.cursor.execute(query)
-        return self.cursor.fetchone()
+    def execute_query_with_return_one(self, query, params=()):
+        with self.reader() as cursor, self.timed(query, params):
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+    def iterate_query(self, query, params=()):
+        """Yields the rows of a query as they are read, instead of fetching them all first
+
+        The reader stays checked out until the generator is exhausted or closed."""
+        with self.reader() as cursor:
+            cursor.execute(query, params)
+            while rows := cursor.fetchmany(STREAM_FETCH_SIZE):
+                yield from rows
     
     def execute_script(self, script):
-        logger.debug(f"Executing script {script}")
+        logger.info("Executing script %s", script)
         
-        with open(script, 'r') as sql_script:
+        with open(script, 'r') as sql_script, self.writer() as cursor:
 
-            self.cursor.executescript(sql_script.read())
-        logger.debug(f"Finished executing script {script}")
-        self.conn.commit()
+            cursor.executescript(sql_script.read())
+            self.conn.commit()
+        logger.info("Finished executing script %s", script)
 
     def add_reservation(self, customer_id, equipment, start_date, end_date, cost, downpayment, location):
-        #print(f"'{customer_id}', '{equipment}', '{start_date}', '{end_date}', 'TRUE', '{cost}', '{downpayment}','{location}'")
-        self.insert("reservations", "username, equipment, start_date, end_date, active, cost, downpayment, location",
-                    f"'{customer_id}', '{equipment}', '{start_date}', '{end_date}', TRUE, '{cost}', '{downpayment}','{location}'")
+        return self.execute_query(INSERT_RESERVATION,
+                           (customer_id, equipment, to_epoch(start_date), to_epoch(end_date), cost, downpayment, location))
         
+    def add_reservations(self, reservations: list) -> int:
+        """Inserts many reservations with a single executemany in one transaction
+
+        Each item holds the INSERT_RESERVATION values: username, equipment,
+        start_date, end_date, cost, downpayment and location. Returns the id of
+        the last one; the ids of a batch follow each other, as nothing else
+        writes during its transaction."""
+        # the plan of the first row stands for the whole batch
+        first = reservations[0] if reservations else ()
+        if self.committer:
+            with self.timed(INSERT_RESERVATION, first):
+                return self.committer.submit(INSERT_RESERVATION, reservations, many=True).result()
+
+        def write(cursor):
+            cursor.executemany(INSERT_RESERVATION, reservations)
+            return cursor.execute(LAST_INSERT_ID).fetchone()[0]
+
+        with self.timed(INSERT_RESERVATION, first):
+            return self._transaction(write)
+
+    def list_machines(self) -> list:
+        return self.execute_query_with_return(SELECT_MACHINES)
+
+    def active_intervals(self) -> list:
+        return self.execute_query_with_return(SELECT_ACTIVE_INTERVALS)
+
+    def index_snapshot(self) -> tuple:
+        """Returns the active intervals and the id of the last reservation change they include
+
+        Both are read in one transaction, so following the changes after that id
+        neither misses nor repeats one."""
+        with self.reader() as cursor:
+            cursor.execute("BEGIN")
+            try:
+                intervals = cursor.execute(SELECT_ACTIVE_INTERVALS).fetchall()
+                last_change = cursor.execute(SELECT_LAST_CHANGE).fetchone()[0]
+            finally:
+                cursor.execute("COMMIT")
+        return intervals, last_change
+
+    def track_changes(self, enabled: bool) -> None:
+        """Creates the triggers that log every booking and cancellation to reservation_changes, or drops them
+
+        Only processes sharing the database read the log, a process alone on it
+        would pay an extra insert per write for nothing. The triggers are checked
+        first, so workers starting together only write when the mode changed."""
+        present = {row[0] for row in self.execute_query_with_return(SELECT_CHANGE_TRIGGERS)}
+        if present == (set(CHANGE_TRIGGERS) if enabled else set()):
+            return
+
+        def write(cursor):
+            cursor.execute("BEGIN IMMEDIATE")
+            for name, sql in CHANGE_TRIGGERS.items():
+                cursor.execute(sql if enabled else f"DROP TRIGGER IF EXISTS {name}")
+
+        self._transaction(write)
+
+    def reservation_changes(self, after: int) -> list:
+        """Returns the (change_id, equipment, start_date, end_date, delta) changes after `after`"""
+        return self.execute_query_with_return(SELECT_CHANGES_SINCE, (after,))
+
     def show_reservations(self):
-        return self.select("reservations", "*", "active = TRUE")
+        return self.execute_query_with_return(SELECT_ACTIVE_RESERVATIONS)
     
     def cancel_reservation(self, reservation_id : int) -> tuple:
-        self.update("reservations", "active = FALSE", f"reservation_id = {reservation_id}")
+        """Cancels an active reservation in one statement
 
-        # return the downpayment and reservation_date
-        res = self.select("reservations", "downpayment, start_date", f"reservation_id = {reservation_id}")
-        
-        start_date = res[0][1]
-        start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')
+        Returns its (equipment, start_date, end_date, downpayment), None when it is
+        unknown or was already cancelled."""
+        res = self.execute_write_with_return(CANCEL_RESERVATION, (reservation_id,))
+        return res[0] if res else None
 
-        downpayment = res[0][0]
+    def cancel_reservations(self, condition: str, params: tuple) -> list:
+        """Cancels the active reservations matching `condition` in one transaction
 
-        return downpayment, start_date
+        Returns (reservation_id, equipment, start_date, end_date, downpayment) of each."""
+        return self.execute_write_with_return(CANCEL_RESERVATIONS.format(condition=condition), params)
         
 
     def check_reservation(self, reservation_id : int) -> list:
     
-        return self.select("reservations", "*", f"reservation_id = {reservation_id}")
+        return self.execute_query_with_return(SELECT_RESERVATION, (reservation_id,))
     
     def list_reservations(self, start_date : datetime.datetime, end_date : datetime.datetime):
-        return self.select("reservations", "*", f"start_date >= '{start_date}' AND end_date <= '{end_date}'")
+        return self.execute_query_with_return(SELECT_RESERVATIONS_BETWEEN, (to_epoch(start_date), to_epoch(end_date)))
     
     def remove_user(self, username : str):
-        self.update("users", "active = FALSE", f"username = '{username}'")
+        self.execute_query(DEACTIVATE_USER, (username,))
 
     def add_user(self, username : str, first_name : str, role : str) -> None:
 
-        self.insert("users", "username, first_name, active", f"'{username}', '{first_name}', 'TRUE'")
+        self.execute_query(INSERT_USER, (username, first_name))
         # get user id
-        uid=self.select("users","user_id", f"username = '{username}'")
+        uid=self.execute_query_with_return(SELECT_USER_ID, (username,))
         if uid:
             uid=uid[0][0]
         else:
             return
         # get role id
-        role=self.select("roles","role_id", f"role = '{role}'")
+        role=self.execute_query_with_return(SELECT_ROLE_ID, (role,))
         if role:
             role=role[0][0]
         else:
             return
 
-        add = f"'{uid}', '{role}'"
-        self.insert("user_roles", "user_id, role_id", add)
+        self.execute_query(INSERT_USER_ROLE, (uid, role))
 
     def change_user_role(self, username : str, role : str) -> None:
         # get role id
-        role=self.select("roles","role_id", f"role = '{role}'")
+        role=self.execute_query_with_return(SELECT_ROLE_ID, (role,))
         if role:
             role=role[0][0]
         else:
             return
         # get user id
-        uid=self.select("users","user_id", f"username = '{username}'")
+        uid=self.execute_query_with_return(SELECT_USER_ID, (username,))
         if uid:
             uid=uid[0][0]
 
 
-            self.update("user_roles", f"role_id = '{role}'", f"user_id = {uid}")
+            self.execute_query(UPDATE_USER_ROLE, (role, uid))
 
     def login_user(self, username : str) -> str:
-        print(f"username = '{username}' and active = TRUE")
-        return self.select("users", "first_name", f"username = '{username}' and active = 'TRUE'")[0][0]
+        return self.execute_query_with_return(SELECT_FIRST_NAME, (username,))[0][0]
+
+    def user_identity(self, username : str) -> list:
+        """Returns (user_id, username, first_name, active, role) for every user row
+        with this username, role is None for users without one"""
+        return self.execute_query_with_return(SELECT_IDENTITY, (username,))
 
     def close(self):
-        self.conn.close()
\ No newline at end of file
+        if self.committer:
+            self.committer.close()
+        for conn in self.reader_conns:
+            conn.close()
+        self.conn.close()
+
+
+class AsyncDBUtils:
+    """aiosqlite backed counterpart of DBUtils
+
+    Exposes the same methods as DBUtils as coroutines so the api endpoints can
+    await their queries instead of blocking the event loop. Like DBUtils it
+    keeps one writer and several reader connections; each aiosqlite connection
+    runs on its own thread, so reads proceed in parallel. Connections are
+    opened lazily on first use, so the object can be built outside of a
+    running loop. With `group_commit` the writes are handed to a
+    GroupCommitter and awaited, instead of committing one by one. With
+    `profile` the queries are recorded by a QueryProfiler.
+
+    Queries pass through the bounded `reads` and `writes` executors, which
+    refuse them with Overloaded once too many are queued or one takes too
+    long; their threads also take CPU bound work off the event loop. Streams
+    from iterate_query are not bounded, they hold a reader for as long as the
+    client keeps reading."""
+
+    def __init__(self, db_name, readers=READER_POOL_SIZE, group_commit=GROUP_COMMIT, profile=PROFILE_QUERIES):
+        self.db_name = db_name
+        self.readers = readers
+        self.committer = GroupCommitter(self.db_name) if group_commit else None
+        self.profiler = QueryProfiler() if profile else None
+        self.reads = BoundedExecutor("read", EXECUTOR_READ_WORKERS, EXECUTOR_QUEUE_DEPTH, EXECUTOR_TIMEOUT)
+        self.writes = BoundedExecutor("write", EXECUTOR_WRITE_WORKERS, EXECUTOR_QUEUE_DEPTH, EXECUTOR_TIMEOUT)
+        self.conn = None
+        # event loop -> the asyncio.Lock its coroutines take around a write transaction
+        self.write_locks = weakref.WeakKeyDictionary()
+        self.reader_conns = []
+        self.next_reader = itertools.count()
+
+    async def _open(self, **kwargs):
+        conn = await aiosqlite.connect(self.db_name, timeout=BUSY_TIMEOUT,
+                                       cached_statements=STATEMENT_CACHE_SIZE, **kwargs)
+        await conn.execute("PRAGMA journal_mode = WAL")
+        return conn
+
+    async def _connection(self):
+        if self.conn is None:
+            conn = await self._open(isolation_level="IMMEDIATE")
+            # another coroutine may have connected while we were waiting
+            if self.conn is None:
+                self.conn = conn
+            else:
+                await conn.close()
+        return self.conn
+
+    async def _reader(self):
+        if len(self.reader_conns) < self.readers:
+            conn = await self._open()
+            if len(self.reader_conns) < self.readers:
+                self.reader_conns.append(conn)
+                return conn
+            await conn.close()
+        # each connection has its own thread and every query its own cursor,
+        # so handing connections out round robin is safe
+        return self.reader_conns[next(self.next_reader) % len(self.reader_conns)]
+
+    async def create_table(self, table_name, columns):
+        query = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})"
+        await self.execute_query(query)
+
+    async def insert(self, table_name, columns, values, params=()):
+        query = f"INSERT INTO {table_name} ({columns}) VALUES ({values})"
+        await self.execute_query(query, params)
+
+    async def select(self, table_name, columns, condition='1=1', params=()):
+        query = f"SELECT {columns} FROM {table_name} WHERE {condition}"
+
+        query_logger.debug("select", extra={"query": query})
+
+        return await self.execute_query_with_return(query, params)
+
+    def select_iter(self, table_name, columns, condition='1=1', params=()):
+        query = f"SELECT {columns} FROM {table_name} WHERE {condition}"
+        return self.iterate_query(query, params)
+
+    async def update(self, table_name, columns, condition, params=()):
+        query = f"UPDATE {table_name} SET {columns} WHERE {condition}"
+        await self.execute_query(query, params)
+
+    async def delete(self, table_name, condition, params=()):
+        query = f"DELETE FROM {table_name} WHERE {condition}"
+        await self.execute_query(query, params)
+
+    async def _observe(self, query, params, start):
+        """Async counterpart of DBUtils.timed, called once `query` has run since `start`"""
+        seconds = time.perf_counter() - start
+        QUERY_LATENCY.observe(seconds, statement(query))
+        if self.profiler is not None and self.profiler.record(query, seconds):
+            plan = None
+            if self.profiler.needs_plan(query):
+                try:
+                    conn = await self._reader()
+                    async with conn.execute("EXPLAIN QUERY PLAN " + query, params) as cursor:
+                        plan = await cursor.fetchall()
+                except sqlite3.Error as e:
+                    logger.info("Could not explain %s: %s", statement(query), e)
+            self.profiler.log_slow(query, seconds, plan)
+
+    def _write_lock(self) -> asyncio.Lock:
+        """The lock of the running loop, one transaction at a time uses the writer"""
+        loop = asyncio.get_running_loop()
+        lock = self.write_locks.get(loop)
+        if lock is None:
+            lock = self.write_locks[loop] = asyncio.Lock()
+        return lock
+
+    async def _transaction(self, write):
+        """Async counterpart of DBUtils._transaction, `write` is a coroutine function of the writer"""
+        conn = await self._connection()
+        lock = self._write_lock()
+        for attempt in itertools.count():
+            # only the wait for the writer is timed, a write that has begun runs to its commit or rollback
+            await self.writes.acquire(lock)
+            try:
+                result = await write(conn)
+                await conn.commit()
+                return result
+            except sqlite3.OperationalError as e:
+                if conn.in_transaction:
+                    await conn.rollback()
+                if not is_busy(e) or attempt >= BUSY_RETRIES:
+                    raise
+            finally:
+                lock.release()
+            await asyncio.sleep(backoff(attempt))
+
+    async def _write(self, query, params, many=False):
+        """Runs a write through the group committer or a transaction, returns the rowid of the last inserted row"""
+        if self.committer:
+            return await asyncio.wrap_future(self.committer.submit(query, params, many=many))
+
+        async def write(conn):
+            if many:
+                await conn.executemany(query, params)
+                async with conn.execute(LAST_INSERT_ID) as cursor:
+                    return (await cursor.fetchone())[0]
+            async with conn.execute(query, params) as cursor:
+                return cursor.lastrowid
+
+        return await self._transaction(write)
+
+    async def _read(self, query, params, one=False):
+        conn = await self._reader()
+        async with conn.execute(query, params) as cursor:
+            return await (cursor.fetchone() if one else cursor.fetchall())
+
+    async def execute_query(self, query, params=()):
+        start = time.perf_counter()
+        # a write is not cut off between its statement and its commit, only its wait for the writer is timed
+        row_id = await self.writes.wait(self._write(query, params), finish=True)
+        await self._observe(query, params, start)
+        return row_id
+
+    async def execute_write_with_return(self, query, params=()):
+        """Async version of DBUtils.execute_write_with_return"""
+        start = time.perf_counter()
+
+        async def write(conn):
+            async with conn.execute(query, params) as cursor:
+                return await cursor.fetchall()
+
+        rows = await self.writes.wait(self._transaction(write), finish=True)
+        await self._observe(query, params, start)
+        return rows
+
+    async def execute_query_with_return(self, query, params=()):
+        start = time.perf_counter()
+        rows = await self.reads.wait(self._read(query, params))
+        await self._observe(query, params, start)
+        return rows
+
+    async def execute_query_with_return_one(self, query, params=()):
+        start = time.perf_counter()
+        row = await self.reads.wait(self._read(query, params, one=True))
+        await self._observe(query, params, start)
+        return row
+
+    async def iterate_query(self, query, params=()):
+        """Yields the rows of a query as they are read, instead of fetching them all first"""
+        conn = await self._reader()
+        async with conn.execute(query, params) as cursor:
+            # rows are handed over from the connection thread this many at a time
+            cursor.arraysize = STREAM_FETCH_SIZE
+            async for row in cursor:
+                yield row
+
+    async def execute_script(self, script):
+        logger.info("Executing script %s", script)
+
+        with open(script, 'r') as sql_script:
+            conn = await self._connection()
+            await conn.executescript(sql_script.read())
+        logger.info("Finished executing script %s", script)
+        await conn.commit()
+
+    async def add_reservation(self, customer_id, equipment, start_date, end_date, cost, downpayment, location):
+        return await self.execute_query(INSERT_RESERVATION,
+                                 (customer_id, equipment, to_epoch(start_date), to_epoch(end_date), cost, downpayment, location))
+
+    async def add_reservations(self, reservations: list) -> int:
+        start = time.perf_counter()
+        row_id = await self.writes.wait(self._write(INSERT_RESERVATION, reservations, many=True), finish=True)
+        await self._observe(INSERT_RESERVATION, reservations[0] if reservations else (), start)
+        return row_id
+
+    async def list_machines(self) -> list:
+        return await self.execute_query_with_return(SELECT_MACHINES)
+
+    async def active_intervals(self) -> list:
+        return await self.execute_query_with_return(SELECT_ACTIVE_INTERVALS)
+
+    async def index_snapshot(self) -> tuple:
+        """Async version of DBUtils.index_snapshot, on a connection of its own for the transaction"""
+        conn = await self._open()
+        try:
+            await conn.execute("BEGIN")
+            async with conn.execute(SELECT_ACTIVE_INTERVALS) as cursor:
+                intervals = await cursor.fetchall()
+            async with conn.execute(SELECT_LAST_CHANGE) as cursor:
+                last_change = (await cursor.fetchone())[0]
+            await conn.execute("COMMIT")
+        finally:
+            await conn.close()
+        return intervals, last_change
+
+    async def reservation_changes(self, after: int) -> list:
+        return await self.execute_query_with_return(SELECT_CHANGES_SINCE, (after,))
+
+    async def show_reservations(self):
+        return await self.execute_query_with_return(SELECT_ACTIVE_RESERVATIONS)
+
+    async def cancel_reservation(self, reservation_id: int) -> tuple:
+        res = await self.execute_write_with_return(CANCEL_RESERVATION, (reservation_id,))
+        return res[0] if res else None
+
+    async def cancel_reservations(self, condition: str, params: tuple) -> list:
+        return await self.execute_write_with_return(CANCEL_RESERVATIONS.format(condition=condition), params)
+
+    async def check_reservation(self, reservation_id: int) -> list:
+
+        return await self.execute_query_with_return(SELECT_RESERVATION, (reservation_id,))
+
+    async def list_reservations(self, start_date: datetime.datetime, end_date: datetime.datetime):
+        return await self.execute_query_with_return(SELECT_RESERVATIONS_BETWEEN, (to_epoch(start_date), to_epoch(end_date)))
+
+    async def remove_user(self, username: str):
+        await self.execute_query(DEACTIVATE_USER, (username,))
+
+    async def add_user(self, username: str, first_name: str, role: str) -> None:
+
+        await self.execute_query(INSERT_USER, (username, first_name))
+        # get user id
+        uid = await self.execute_query_with_return(SELECT_USER_ID, (username,))
+        if uid:
+            uid = uid[0][0]
+        else:
+            return
+        # get role id
+        role = await self.execute_query_with_return(SELECT_ROLE_ID, (role,))
+        if role:
+            role = role[0][0]
+        else:
+            return
+
+        await self.execute_query(INSERT_USER_ROLE, (uid, role))
+
+    async def change_user_role(self, username: str, role: str) -> None:
+        # get role id
+        role = await self.execute_query_with_return(SELECT_ROLE_ID, (role,))
+        if role:
+            role = role[0][0]
+        else:
+            return
+        # get user id
+        uid = await self.execute_query_with_return(SELECT_USER_ID, (username,))
+        if uid:
+            uid = uid[0][0]
+
+            await self.execute_query(UPDATE_USER_ROLE, (role, uid))
+
+    async def login_user(self, username: str) -> str:
+        return (await self.execute_query_with_return(SELECT_FIRST_NAME, (username,)))[0][0]
+
+    async def user_identity(self, username: str) -> list:
+        return await self.execute_query_with_return(SELECT_IDENTITY, (username,))
+
+    async def close(self):
+        self.reads.shutdown()
+        self.writes.shutdown()
+        if self.committer:
+            self.committer.close()
+        for conn in self.reader_conns:
+            await conn.close()
+        self.reader_conns = []
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
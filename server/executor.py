@@ -0,0 +1,186 @@
+"""Bounded pools for the work the event loop hands off
+
+A BoundedExecutor caps how many calls may be in flight (running on one of its
+workers or queued behind them) and how long each may take, waiting included.
+A call past the cap, or past its time, fails at once with Overloaded, which the
+api answers with 503, instead of queueing without end behind a slow query.
+
+AsyncDBUtils keeps one for reads and one for writes: the aiosqlite calls pass
+through them with wait, and CPU bound work such as encoding a large page runs
+on their threads with call, off the event loop. A write is only timed while it
+queues for the writer: once it has begun it may have committed, and a caller
+told it failed would retry it.
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from server.metrics import CONNECTION_WAIT, EXECUTOR_REJECTED
+
+
+class Overloaded(Exception):
+    """A call was refused because its pool was full, or took longer than the pool allows"""
+
+
+# set while the caller finishes work whose write has committed, see unbounded
+UNBOUNDED = contextvars.ContextVar("unbounded", default=False)
+
+
+@contextmanager
+def unbounded():
+    """Lets the database calls made within run past the pools' caps and timeouts
+
+    For the steps after a commit, such as indexing a booking: failing them with
+    Overloaded would answer 503 for a write that took place."""
+
+    token = UNBOUNDED.set(True)
+    try:
+        yield
+    finally:
+        UNBOUNDED.reset(token)
+
+
+class BoundedExecutor:
+    """A thread pool with a bounded queue and a per call timeout
+
+    The count of calls in flight is kept under a threading lock rather than an
+    asyncio primitive, so one executor serves every event loop it is used from.
+
+    Parameters
+    ----------
+    name: str
+        - The pool label of the metrics and errors, "read" or "write"
+    workers: int
+        - The calls that run at the same time
+    queue_depth: int
+        - The calls that may wait for a worker, more are refused
+    timeout: float
+        - Seconds a call may take from submission, None to wait as long as it takes"""
+
+    def __init__(self, name: str, workers: int, queue_depth: int, timeout: float = None):
+        self.name = name
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def _admit(self) -> None:
+        with self.lock:
+            if self.in_flight >= self.workers + self.queue_depth:
+                EXECUTOR_REJECTED.inc(self.name, "full")
+                raise Overloaded(f"The {self.name} pool is full, {self.in_flight} calls in flight")
+            self.in_flight += 1
+
+    def _done(self, future) -> None:
+        with self.lock:
+            self.in_flight -= 1
+        # an error the caller stopped waiting for is not reported as never retrieved
+        if not future.cancelled():
+            future.exception()
+
+    async def _bounded(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            EXECUTOR_REJECTED.inc(self.name, "timeout")
+            raise Overloaded(f"The {self.name} pool call took more than {self.timeout}s") from None
+
+    async def wait(self, awaitable, finish: bool = False):
+        """Awaits work that already runs on a thread of its own, such as an aiosqlite call,
+        within the pool's bounds
+
+        The work holds its place in the pool until it is done, even once its caller
+        has timed out.
+
+        Parameters
+        ----------
+        awaitable: awaitable
+            - The work to await
+        finish: bool
+            - Await the work to the end, neither timed out nor cancelled with its caller,
+              for a write that must not stop between its statement and its commit; the
+              write times its queueing itself with acquire
+
+        Returns
+        -------
+        result
+            - What the awaitable returns"""
+
+        if UNBOUNDED.get():
+            return await awaitable
+        try:
+            self._admit()
+        except Overloaded:
+            # the coroutine was never started, close it so it is not reported as never awaited
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise
+        task = asyncio.ensure_future(awaitable)
+        task.add_done_callback(self._done)
+        if finish:
+            return await asyncio.shield(task)
+        return await self._bounded(task)
+
+    async def acquire(self, lock: asyncio.Lock) -> None:
+        """Waits for `lock` within the pool's timeout, for work that queues behind a lock
+        rather than for a worker
+
+        Parameters
+        ----------
+        lock: asyncio.Lock
+            - The lock to acquire, held by the caller once this returns"""
+
+        if UNBOUNDED.get():
+            await lock.acquire()
+            return
+        await self._bounded(lock.acquire())
+
+    async def call(self, fn, *args):
+        """Runs a blocking function on one of the pool's threads
+
+        Parameters
+        ----------
+        fn: callable
+            - The function to run
+        args:
+            - Its arguments
+
+        Returns
+        -------
+        result
+            - What the function returns"""
+
+        self._admit()
+        submitted = time.perf_counter()
+
+        def run():
+            CONNECTION_WAIT.observe(time.perf_counter() - submitted, f"{self.name}_executor")
+            return fn(*args)
+
+        try:
+            future = self._pool().submit(run)
+        except BaseException:
+            with self.lock:
+                self.in_flight -= 1
+            raise
+        future.add_done_callback(self._done)
+        # a call that times out while still queued is dropped, one already running finishes on its own
+        return await self._bounded(asyncio.wrap_future(future))
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix=f"{self.name}-executor")
+        return self.pool
+
+    def shutdown(self) -> None:
+        """Stops the threads once their calls are done, a later call starts new ones"""
+
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
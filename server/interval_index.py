@@ -0,0 +1,239 @@
+import bisect
+import heapq
+import itertools
+import threading
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def peak_usage(intervals: list, start: int, end: int) -> int:
+    """Returns the largest number of intervals in use at the same moment within [start, end)
+
+    Parameters
+    ----------
+    intervals: list
+        - (start, end) pairs
+    start: int
+        - The start of the window
+    end: int
+        - The end of the window
+
+    Returns
+    -------
+    peak: int
+        - The number of intervals in use at the busiest moment"""
+
+    events = []
+    for interval_start, interval_end in intervals:
+        if interval_start < end and interval_end > start:
+            events.append((max(interval_start, start), 1))
+            events.append((min(interval_end, end), -1))
+    # at equal times the -1 sorts first, so back to back bookings do not overlap
+    events.sort()
+
+    peak = in_use = 0
+    for _, change in events:
+        in_use += change
+        peak = max(peak, in_use)
+    return peak
+
+
+def occupancy(intervals: list, start: int, end: int, bucket: int) -> list:
+    """Returns the largest number of intervals in use at the same moment within each bucket of [start, end)
+
+    A difference array over the interval ends: every start adds one and every end
+    takes one away, so the running sum is the number in use after each of them,
+    and the usage can only go up at a start. A bucket's peak is then the usage at
+    its first moment or after one of the starts within it. The sum and the per
+    bucket maximum are vectorized with numpy when it is installed.
+
+    Parameters
+    ----------
+    intervals: list
+        - (start, end) pairs
+    start: int
+        - The start of the first bucket
+    end: int
+        - The end of the window, the last bucket may be cut short by it
+    bucket: int
+        - The length of a bucket
+
+    Returns
+    -------
+    peaks: list
+        - The number of intervals in use at the busiest moment of each bucket"""
+
+    buckets = -(-(end - start) // bucket)
+    clipped = [(max(interval_start, start), min(interval_end, end)) for interval_start, interval_end in intervals
+               if interval_start < end and interval_end > start]
+
+    if numpy is not None:
+        clipped = numpy.array(clipped, dtype=numpy.int64).reshape(-1, 2)
+        times = numpy.concatenate((clipped[:, 0], clipped[:, 1]))
+        deltas = numpy.concatenate((numpy.ones(len(clipped), numpy.int64), -numpy.ones(len(clipped), numpy.int64)))
+        # by time, and at equal times the -1 first, so back to back intervals do not overlap
+        order = numpy.lexsort((deltas, times))
+        times, deltas = times[order], deltas[order]
+        levels = numpy.concatenate(([0], numpy.cumsum(deltas)))
+        edges = start + bucket * numpy.arange(buckets, dtype=numpy.int64)
+        peaks = levels[numpy.searchsorted(times, edges, side="right")]
+        rising = deltas > 0
+        numpy.maximum.at(peaks, (times[rising] - start) // bucket, levels[1:][rising])
+        return peaks.tolist()
+
+    events = sorted(itertools.chain(((interval_start, 1) for interval_start, _ in clipped),
+                                    ((interval_end, -1) for _, interval_end in clipped)))
+    times = [time for time, _ in events]
+    levels = [0, *itertools.accumulate(change for _, change in events)]
+    peaks = [levels[bisect.bisect_right(times, start + i * bucket)] for i in range(buckets)]
+    for (time, change), level in zip(events, levels[1:]):
+        if change > 0:
+            i = (time - start) // bucket
+            peaks[i] = max(peaks[i], level)
+    return peaks
+
+
+class IntervalIndex:
+    """In-memory index of the active reservation intervals of every equipment
+
+    For each equipment the intervals are kept as two parallel arrays of epoch
+    seconds sorted by start time, together with the longest duration seen. An
+    interval overlapping [start, end) has to begin after start - longest, so the
+    candidates are found with two binary searches and only those are scanned:
+    O(log n + k) per query no matter how large the reservation history grows."""
+
+    def __init__(self):
+        self.starts = {}
+        self.ends = {}
+        self.longest = {}
+        self.lock = threading.Lock()
+
+    def load(self, rows: list) -> None:
+        """Replaces the index content with (equipment, start, end) rows"""
+
+        by_equipment = {}
+        for equipment, start, end in rows:
+            by_equipment.setdefault(equipment, []).append((start, end))
+
+        with self.lock:
+            self.starts, self.ends, self.longest = {}, {}, {}
+            for equipment, intervals in by_equipment.items():
+                intervals.sort()
+                self.starts[equipment] = array('q', (start for start, _ in intervals))
+                self.ends[equipment] = array('q', (end for _, end in intervals))
+                self.longest[equipment] = max(end - start for start, end in intervals)
+
+    def add(self, equipment: str, start: int, end: int) -> None:
+        with self.lock:
+            starts = self.starts.setdefault(equipment, array('q'))
+            ends = self.ends.setdefault(equipment, array('q'))
+
+            position = bisect.bisect_right(starts, start)
+            starts.insert(position, start)
+            ends.insert(position, end)
+            self.longest[equipment] = max(self.longest.get(equipment, 0), end - start)
+
+    def remove(self, equipment: str, start: int, end: int) -> bool:
+        """Removes one interval equal to [start, end), returns False if there is none"""
+
+        with self.lock:
+            starts = self.starts.get(equipment)
+            if not starts:
+                return False
+            ends = self.ends[equipment]
+
+            position = bisect.bisect_left(starts, start)
+            while position < len(starts) and starts[position] == start:
+                if ends[position] == end:
+                    del starts[position]
+                    del ends[position]
+                    return True
+                position += 1
+            return False
+
+    def overlapping(self, equipment: str, start: int, end: int) -> list:
+        """Returns the (start, end) intervals of an equipment overlapping [start, end)"""
+
+        with self.lock:
+            starts = self.starts.get(equipment)
+            if not starts:
+                return []
+            ends = self.ends[equipment]
+
+            first = bisect.bisect_right(starts, start - self.longest[equipment])
+            last = bisect.bisect_left(starts, end)
+            return [(starts[i], ends[i]) for i in range(first, last) if ends[i] > start]
+
+    def peak_usage(self, equipment: str, start: int, end: int) -> int:
+        """Returns how many units of an equipment are in use at the busiest moment of [start, end)"""
+
+        return peak_usage(self.overlapping(equipment, start, end), start, end)
+
+    def free_starts(self, equipment: str, available: int, after: int, duration: int, count: int) -> list:
+        """Returns the earliest start of each of the next `count` gaps from `after` on in which
+        fewer than `available` units are in use for at least `duration` seconds
+
+        One sweep in time order over the bookings from `after` on: the starts come
+        in order from the sorted array and the ends from a heap of the bookings still
+        running, so it reads only as far as the gaps it returns. Each gap's start is
+        `after` or the moment a unit frees up; every later moment in the gap up to
+        its end minus `duration` fits the booking as well.
+
+        Parameters
+        ----------
+        equipment: str
+            - The equipment to search
+        available: int
+            - The units of the equipment
+        after: int
+            - The earliest start, in epoch seconds
+        duration: int
+            - The length of the booking, in seconds
+        count: int
+            - The number of gaps to return
+
+        Returns
+        -------
+        starts: list
+            - Epoch seconds, ascending; the last gap found may run on without end"""
+
+        if available < 1:
+            return []
+        with self.lock:
+            starts = self.starts.get(equipment, array('q'))
+            ends = self.ends.get(equipment, array('q'))
+
+            # the bookings running at `after`, by end time
+            position = bisect.bisect_right(starts, after)
+            running = [ends[i] for i in range(bisect.bisect_right(starts, after - self.longest.get(equipment, 0)),
+                                              position) if ends[i] > after]
+            heapq.heapify(running)
+
+            found = []
+            moment, free_since = after, None
+            while len(found) < count:
+                if len(running) < available:
+                    if free_since is None:
+                        free_since = moment
+                elif free_since is not None:
+                    if moment - free_since >= duration:
+                        found.append(free_since)
+                    free_since = None
+
+                following = running[:1] + starts[position:position + 1].tolist()
+                if not following:
+                    # nothing is booked from here on
+                    found.append(free_since)
+                    break
+                moment = min(following)
+                # a booking ending at the moment another one starts frees its unit first
+                while running and running[0] <= moment:
+                    heapq.heappop(running)
+                while position < len(starts) and starts[position] <= moment:
+                    heapq.heappush(running, ends[position])
+                    position += 1
+            return found
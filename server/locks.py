@@ -0,0 +1,79 @@
+"""Per key locks, for serializing bookings of the same equipment
+
+Checking availability and inserting a booking are separate steps, and a
+concurrent booking of the same equipment must not slip in between them. A lock
+per equipment keeps those steps atomic while bookings of other equipment go
+ahead in parallel, with no lock over the whole service.
+"""
+
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+
+class KeyedLocks:
+    """One lock per key, created on first use and dropped once no one holds or waits for it
+
+    Dropping idle locks keeps the table as small as the number of keys in use, and
+    means an asyncio lock never outlives the event loop it was used on.
+
+    Parameters
+    ----------
+    factory: callable
+        - Makes a lock, threading.Lock for threads or asyncio.Lock for coroutines"""
+
+    def __init__(self, factory=threading.Lock):
+        self.factory = factory
+        # key -> [lock, holders and waiters]
+        self.locks = {}
+        self.guard = threading.Lock()
+
+    def _check_out(self, key):
+        with self.guard:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [self.factory(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _check_in(self, key) -> None:
+        with self.guard:
+            entry = self.locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    @contextmanager
+    def hold(self, *keys):
+        """Holds the threading locks of `keys`, taken in sorted order so two holders never deadlock"""
+
+        keys = sorted(set(keys))
+        locks = [self._check_out(key) for key in keys]
+        held = 0
+        try:
+            for lock in locks:
+                lock.acquire()
+                held += 1
+            yield
+        finally:
+            for lock in reversed(locks[:held]):
+                lock.release()
+            for key in keys:
+                self._check_in(key)
+
+    @asynccontextmanager
+    async def hold_async(self, *keys):
+        """Async version of hold, for asyncio locks"""
+
+        keys = sorted(set(keys))
+        locks = [self._check_out(key) for key in keys]
+        held = 0
+        try:
+            for lock in locks:
+                await lock.acquire()
+                held += 1
+            yield
+        finally:
+            for lock in reversed(locks[:held]):
+                lock.release()
+            for key in keys:
+                self._check_in(key)
@@ -0,0 +1,139 @@
+"""Logging set up for the service
+
+Modules only ask for `logging.getLogger(__name__)`; the service calls configure()
+once at start up. Records are put on a queue by a QueueHandler and written by a
+QueueListener thread, so a request never waits on the terminal or a file. Lines
+are json objects, one per record, with any `extra` fields next to the message.
+Levels are set per module, and the per-query loggers pass only a sample of their
+records, see SampleFilter.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+from server.settings import LOG_FILE, LOG_LEVEL, LOG_LEVELS, LOG_QUERY_SAMPLE_RATE
+
+# loggers that write one record per query, sampled at LOG_QUERY_SAMPLE_RATE
+QUERY_LOGGERS = ("server.db_utils.queries",)
+
+# LogRecord attributes that are not `extra` fields
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one json object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": round(record.created, 6), "level": record.levelname,
+                 "logger": record.name, "msg": record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Lets through a random `rate` share of the records, and every warning or worse
+
+    Parameters
+    ----------
+    rate: float
+        - The share of records to keep, between 0 and 1"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def parse_levels(spec: str) -> dict:
+    """Parses "module=LEVEL,module=LEVEL" into {module: level}
+
+    Parameters
+    ----------
+    spec: str
+        - The comma separated logger name and level pairs
+
+    Returns
+    -------
+    levels: dict
+        - The level name of every logger named in spec"""
+
+    levels = {}
+    for pair in spec.split(","):
+        if "=" in pair:
+            name, level = pair.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure(level: str = LOG_LEVEL, levels: str = LOG_LEVELS, sample_rate: float = LOG_QUERY_SAMPLE_RATE,
+              stream=None) -> logging.handlers.QueueListener:
+    """Routes all logging through a queue to a background writer
+
+    Calling it again replaces the previous set up.
+
+    Parameters
+    ----------
+    level: str
+        - The level of the root logger
+    levels: str
+        - Per module levels, "server.db_utils=DEBUG,server.res_system=INFO"
+    sample_rate: float
+        - The share of per query records kept
+    stream: file
+        - Where to write, stderr unless LOG_FILE is set
+
+    Returns
+    -------
+    listener: logging.handlers.QueueListener
+        - The running writer"""
+
+    global _listener
+    shutdown()
+
+    if stream is not None:
+        handler = logging.StreamHandler(stream)
+    elif LOG_FILE:
+        handler = logging.FileHandler(LOG_FILE)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter())
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level.upper())
+
+    for name, module_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(module_level)
+    for name in QUERY_LOGGERS:
+        query_logger = logging.getLogger(name)
+        query_logger.filters = [f for f in query_logger.filters if not isinstance(f, SampleFilter)]
+        query_logger.addFilter(SampleFilter(sample_rate))
+
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown() -> None:
+    """Writes out the queued records and stops the background writer"""
+
+    global _listener
+    root = logging.getLogger()
+    for handler in [h for h in root.handlers if isinstance(h, logging.handlers.QueueHandler)]:
+        root.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,218 @@
+"""Counters and latency histograms, served in the Prometheus text format
+
+The metrics are plain in-process objects: recording is a bisect into the bucket
+bounds and a few additions under a lock, cheap enough to leave on. REGISTRY
+renders all of them for the /metrics endpoint. MetricsMiddleware records every
+request by route template, DBUtils records every query by statement and the time
+spent waiting for a connection.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+# upper bounds in seconds, from half a millisecond up to ten seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named metric with one series per combination of label values
+
+    Parameters
+    ----------
+    name: str
+        - The metric name
+    documentation: str
+        - The HELP text
+    labelnames: tuple
+        - The names of the labels, their values are passed positionally when recording"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def render(self) -> list:
+        """Returns the exposition lines of the metric"""
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            series = [(labels, self._snapshot(value)) for labels, value in sorted(self.series.items())]
+        for labels, value in series:
+            lines.extend(self._render_series(labels, value))
+        return lines
+
+    def _snapshot(self, value):
+        return value
+
+    def _render_series(self, labels: tuple, value) -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_number(value)}"]
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets, with their sum and count
+
+    Parameters
+    ----------
+    buckets: tuple
+        - The sorted upper bounds of the buckets, +Inf is added"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                # a count per bucket, the +Inf bucket last, then the sum
+                series = self.series[labels] = [0] * (len(self.bounds) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observes the seconds spent in the with block"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _snapshot(self, value):
+        return list(value)
+
+    def _render_series(self, labels: tuple, value) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), value):
+            cumulative += count
+            le = f'le="{_format_number(bound)}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+        label_text = _format_labels(self.labelnames, labels)
+        lines.append(f"{self.name}_sum{label_text} {_format_number(value[-1])}")
+        lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The metrics served together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format"""
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    "http_requests_total", "Requests handled, by route and status code", ("method", "route", "status")))
+REQUEST_ERRORS = REGISTRY.register(Counter(
+    "http_request_errors_total", "Requests that failed with a server error or an exception", ("method", "route")))
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Time from receiving a request to sending the last of its response",
+    ("method", "route")))
+QUERY_LATENCY = REGISTRY.register(Histogram(
+    "db_query_duration_seconds", "Time to run a query, by statement template", ("statement",)))
+CONNECTION_WAIT = REGISTRY.register(Histogram(
+    "db_connection_wait_seconds", "Time spent waiting for a database connection or a commit slot", ("pool",)))
+EXECUTOR_REJECTED = REGISTRY.register(Counter(
+    "executor_rejected_total", "Calls refused because their pool was full or took too long", ("pool", "reason")))
+
+
+@lru_cache(maxsize=1024)
+def statement(query: str) -> str:
+    """The label of a query: its template with the whitespace collapsed"""
+
+    return " ".join(query.split())
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the count, errors and latency of every request
+
+    Requests are labelled by the template of the route they matched, such as
+    /reservation/getbytime, so query strings and path parameters do not add series.
+
+    Parameters
+    ----------
+    app: ASGI application
+        - The application to wrap"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception:
+            status = 500
+            raise
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            REQUEST_LATENCY.observe(time.perf_counter() - start, method, path)
+            REQUESTS.inc(method, path, str(status))
+            if status >= 500:
+                REQUEST_ERRORS.inc(method, path)
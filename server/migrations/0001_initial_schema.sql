@@ -1,7 +1,6 @@
 
 -- Maintains information on the reservations
-DROP TABLE IF EXISTS reservations;
-CREATE TABLE reservations (
+CREATE TABLE IF NOT EXISTS reservations (
     reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
     username VARCHAR,
     equipment VARCHAR,
@@ -16,7 +15,6 @@ CREATE TABLE reservations (
 
 
 -- Maintains information on the precise time that machines are booked
-DROP TABLE IF EXISTS machine_bookings;
 CREATE TABLE IF NOT EXISTS machine_bookings (
     reservation_id INTEGER,
     equipment VARCHAR,
@@ -27,7 +25,6 @@ CREATE TABLE IF NOT EXISTS machine_bookings (
 );
 
 -- Maintains user information
-DROP TABLE IF EXISTS users;
 CREATE TABLE IF NOT EXISTS users (
     user_id INTEGER PRIMARY KEY AUTOINCREMENT,
     username VARCHAR,
@@ -36,22 +33,19 @@ CREATE TABLE IF NOT EXISTS users (
 );
 
 -- Maintains information about user roles
-DROP TABLE IF EXISTS roles;
 CREATE TABLE IF NOT EXISTS roles (
     role_id INTEGER PRIMARY KEY AUTOINCREMENT,
     role VARCHAR
 );
 
 -- Maintains information about which users have which roles
-DROP TABLE IF EXISTS user_roles;
-CREATE TABLE user_roles (
+CREATE TABLE IF NOT EXISTS user_roles (
     user_id INTEGER,
     role_id INTEGER,
     PRIMARY KEY (user_id, role_id)
 );
 
 -- Maintains information on the number of machines available
-DROP TABLE IF EXISTS machines;
 CREATE TABLE IF NOT EXISTS machines (
     equipment VARCHAR,
     available INTEGER,
@@ -59,8 +53,7 @@ CREATE TABLE IF NOT EXISTS machines (
 );
 
 ----- CREATE VIEWS TO MAKE LIFE EASIER -----
-DROP VIEW IF EXISTS user_roles_view;
-CREATE VIEW user_roles_view AS
+CREATE VIEW IF NOT EXISTS user_roles_view AS
     SELECT
         u.user_id,
         u.username,
@@ -71,8 +64,7 @@ CREATE VIEW user_roles_view AS
     INNER JOIN user_roles ur ON u.user_id = ur.user_id
     INNER JOIN roles r ON ur.role_id = r.role_id;
 
-DROP VIEW IF EXISTS reservations_view;
-CREATE VIEW reservations_view AS
+CREATE VIEW IF NOT EXISTS reservations_view AS
     SELECT
         r.reservation_id,
         r.username as username,
@@ -0,0 +1,15 @@
+-- Indexes for the lookups every endpoint makes
+
+-- availability checks and getbyequip filter on equipment and time
+CREATE INDEX IF NOT EXISTS reservations_equipment_dates_idx ON reservations (equipment, start_date, end_date);
+-- getbyuser filters on username and time
+CREATE INDEX IF NOT EXISTS reservations_username_start_idx ON reservations (username, start_date);
+-- getbytime filters on time alone
+CREATE INDEX IF NOT EXISTS reservations_start_end_idx ON reservations (start_date, end_date);
+
+-- logins, user changes and the join in reservations_view
+CREATE INDEX IF NOT EXISTS users_username_idx ON users (username);
+CREATE INDEX IF NOT EXISTS roles_role_idx ON roles (role);
+CREATE INDEX IF NOT EXISTS machines_equipment_idx ON machines (equipment);
+
+-- user_roles needs no index on user_id, its primary key (user_id, role_id) already starts with it
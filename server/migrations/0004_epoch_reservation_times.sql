@@ -0,0 +1,51 @@
+-- Store reservation times as integer seconds since the epoch (UTC) instead of
+-- DATETIME text, and active as 0 / 1 instead of a mix of 1 and 'TRUE'
+DROP VIEW IF EXISTS reservations_view;
+
+CREATE TABLE reservations_epoch (
+    reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username VARCHAR,
+    equipment VARCHAR,
+    start_date INTEGER,
+    end_date INTEGER,
+    active BOOLEAN,
+    cost INTEGER,
+    downpayment INTEGER,
+    location VARCHAR,
+    FOREIGN KEY (username) REFERENCES users(username)
+);
+
+INSERT INTO reservations_epoch (reservation_id, username, equipment, start_date, end_date, active, cost, downpayment, location)
+    SELECT
+        reservation_id,
+        username,
+        equipment,
+        CAST(strftime('%s', start_date) AS INTEGER),
+        CAST(strftime('%s', end_date) AS INTEGER),
+        active IN (1, 'TRUE'),
+        cost,
+        downpayment,
+        location
+    FROM reservations;
+
+DROP TABLE reservations;
+ALTER TABLE reservations_epoch RENAME TO reservations;
+
+CREATE INDEX IF NOT EXISTS reservations_equipment_dates_idx ON reservations (equipment, start_date, end_date);
+CREATE INDEX IF NOT EXISTS reservations_username_start_idx ON reservations (username, start_date);
+CREATE INDEX IF NOT EXISTS reservations_start_end_idx ON reservations (start_date, end_date);
+
+CREATE VIEW reservations_view AS
+    SELECT
+        r.reservation_id,
+        r.username as username,
+        u.first_name,
+        r.equipment as equipment,
+        r.start_date,
+        r.end_date,
+        r.active,
+        r.cost,
+        r.downpayment,
+        r.location
+    FROM reservations r
+    INNER JOIN users u ON r.username = u.username;
@@ -0,0 +1,12 @@
+-- Log of every booking and cancellation, in commit order, so that each worker
+-- process sharing the database can bring its in-memory interval index up to
+-- date with the reservations the others wrote (see RES_SHARED_DB); the triggers
+-- that write it are only in place in that mode, see DBUtils.track_changes
+CREATE TABLE IF NOT EXISTS reservation_changes (
+    change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    reservation_id INTEGER,
+    equipment VARCHAR,
+    start_date INTEGER,
+    end_date INTEGER,
+    delta INTEGER
+);
@@ -0,0 +1,119 @@
+"""Per statement query profile with a slow query log
+
+A QueryProfiler keeps the count, total and worst duration of every statement
+template DBUtils runs. A statement slower than the threshold is logged with its
+normalised SQL and EXPLAIN QUERY PLAN output, to the server.db_utils.slow logger;
+the plan is captured once per template, the first time it is slow, and reused.
+"""
+
+import logging
+import threading
+
+from server.metrics import statement
+from server.settings import SLOW_QUERY_MS
+
+logger = logging.getLogger("server.db_utils.slow")
+
+# what top() can rank the templates by: total, mean or worst seconds
+ORDERS = {"total": lambda stats: stats[1], "mean": lambda stats: stats[1] / stats[0], "max": lambda stats: stats[2]}
+
+
+def format_plan(rows: list) -> list:
+    """Indents EXPLAIN QUERY PLAN rows into their tree
+
+    Parameters
+    ----------
+    rows: list
+        - The (id, parent, notused, detail) rows of EXPLAIN QUERY PLAN
+
+    Returns
+    -------
+    plan: list
+        - One line per step, indented two spaces per level"""
+
+    depth = {0: -1}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node] + detail)
+    return lines
+
+
+class QueryProfiler:
+    """Collects the durations of the queries by statement template
+
+    Parameters
+    ----------
+    threshold: float
+        - Seconds above which a query is logged as slow"""
+
+    def __init__(self, threshold: float = SLOW_QUERY_MS / 1000):
+        self.threshold = threshold
+        # template -> [count, total seconds, max seconds, slow count]
+        self.stats = {}
+        # template -> EXPLAIN QUERY PLAN lines
+        self.plans = {}
+        self.lock = threading.Lock()
+
+    def record(self, query: str, seconds: float) -> bool:
+        """Adds one run of a query, returns whether it was slow"""
+
+        template = statement(query)
+        slow = seconds >= self.threshold
+        with self.lock:
+            stats = self.stats.get(template)
+            if stats is None:
+                stats = self.stats[template] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += slow
+        return slow
+
+    def needs_plan(self, query: str) -> bool:
+        return statement(query) not in self.plans
+
+    def log_slow(self, query: str, seconds: float, plan_rows: list = None) -> None:
+        """Logs a slow query with its plan, keeping the plan for the next time
+
+        Parameters
+        ----------
+        query: str
+            - The query that was slow
+        seconds: float
+            - How long it took
+        plan_rows: list
+            - The EXPLAIN QUERY PLAN rows, when needs_plan asked for them"""
+
+        template = statement(query)
+        if plan_rows is not None:
+            self.plans[template] = format_plan(plan_rows)
+        logger.warning("slow query", extra={"statement": template, "ms": round(seconds * 1000, 3),
+                                            "plan": self.plans.get(template, [])})
+
+    def top(self, count: int = 10, order: str = "total") -> list:
+        """Returns the slowest statement templates
+
+        Parameters
+        ----------
+        count: int
+            - How many templates to return
+        order: str
+            - Rank by "total", "mean" or "max" time
+
+        Returns
+        -------
+        statements: list
+            - A dictionary per template with its counts, total, mean and max milliseconds and plan"""
+
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: ORDERS[order](item[1]), reverse=True)[:count]
+        return [{"statement": template, "count": runs, "slow": slow, "total_ms": round(total * 1000, 3),
+                 "mean_ms": round(total * 1000 / runs, 3), "max_ms": round(worst * 1000, 3),
+                 "plan": self.plans.get(template)}
+                for template, (runs, total, worst, slow) in stats]
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stats.clear()
+            self.plans.clear()
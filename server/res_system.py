@@ -1,11 +1,25 @@
+import asyncio
 import datetime
-import os
 import logging
-from server.db_utils import DBUtils
+import threading
+from server.db_utils import DBUtils, AsyncDBUtils, to_epoch, from_epoch, format_epoch
+from server.db_migrations import MigrationRunner
+from server.executor import unbounded
+from server.interval_index import IntervalIndex, occupancy
+from server.locks import KeyedLocks
+from server.cache import EquipmentCatalog, TTLCache
+from server.serialize import RowEncoder, dumps
+from server.settings import OCCUPANCY_BUCKETS_MAX, OFFLOAD_ROWS, SHARED_DB
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# column layout of the reservations_view rows the listings select, as shown to the user
+RESERVATION_ENCODER = RowEncoder([("reservation_id", 0, None), ("username", 1, None), ("firstname", 2, None),
+                                  ("equipment", 3, None), ("start_date", 4, format_epoch),
+                                  ("end_date", 5, format_epoch), ("active", 6, None), ("cost", 7, None),
+                                  ("downpayment", 8, None), ("location", 9, None)])
+USER_ENCODER = RowEncoder([("user_id", 0, None), ("username", 1, None), ("first_name", 2, None), ("active", 3, None)])
+
 
 class ReservationSystem:
 
@@ -13,13 +27,67 @@ class ReservationSystem:
         self.db_setup()
 
     def db_setup(self) -> None:
-        """Stand up database, set up tables and seed data"""
+        """Stand up database and apply the pending migrations
+        
+        A new database gets the tables, seed data and indexes; an existing one
+        keeps its data and only runs the migrations it has not seen yet."""
 
         self.db = DBUtils('reservation_system.db')
-        # create tables
-        self.db.execute_script(os.path.join(os.path.dirname(__file__), 'create_db.sql'))
-        # seed_data
-        self.db.execute_script(os.path.join(os.path.dirname(__file__), 'seed_db.sql'))
+        MigrationRunner(self.db).run()
+
+        # active reservations per equipment, kept in step with every booking and cancellation,
+        # and the last reservation_changes row it holds, see _follow
+        self.index = IntervalIndex()
+        self.db.track_changes(SHARED_DB)
+        intervals, self.last_change = self.db.index_snapshot()
+        self.index.load(intervals)
+        # equipment name -> (available, cost), so bookings do not query machines
+        self.catalog = EquipmentCatalog()
+        # username -> identity rows, see _identity
+        self.identities = TTLCache()
+        # equipment name -> lock held from the availability check to the insert of a booking
+        self.booking_locks = KeyedLocks()
+        # one caller at a time reads and applies the reservation_changes log, see _follow
+        self.follow_lock = threading.Lock()
+
+    def _follow(self) -> None:
+        """Brings the interval index up to date with the bookings and cancellations
+        committed since it last looked, by any process
+
+        Only with SHARED_DB, a process alone on the database updates the index as it
+        writes. The changes come from the reservation_changes log in commit order; a
+        process that fell behind the pruned end of the log reloads the whole index."""
+
+        if not SHARED_DB:
+            return
+        with self.follow_lock:
+            changes = self.db.reservation_changes(self.last_change)
+            if changes and changes[0][0] > self.last_change + 1:
+                intervals, self.last_change = self.db.index_snapshot()
+                self.index.load(intervals)
+                return
+            self._apply_changes(changes)
+
+    def _apply_changes(self, changes: list) -> None:
+        """Adds the bookings and removes the cancellations of reservation_changes rows from the index
+
+        Changes the index already holds are skipped, each is applied once."""
+
+        for change_id, equipment, start, end, delta in changes:
+            if change_id <= self.last_change:
+                continue
+            if delta > 0:
+                self.index.add(equipment, start, end)
+            else:
+                self.index.remove(equipment, start, end)
+            self.last_change = change_id
+
+    def _machines(self) -> dict:
+        """Returns the equipment catalog, reloading it from the machines table when stale"""
+
+        if self.catalog.stale():
+            return self.catalog.fill(self.db.list_machines())
+        return self.catalog.machines
 
     def _find_equipment(self, equipment_name: str) -> str:
         """Returns the equipment object if it exists, otherwise returns None
@@ -34,7 +102,7 @@ class ReservationSystem:
         equipment: Equipment
             - The equipment object if it exists, otherwise None"""
 
-        if self.db.select('machines', '*', f"""equipment = '{equipment_name}' """):
+        if equipment_name in self._machines():
             return equipment_name
         return None
 
@@ -55,14 +123,33 @@ class ReservationSystem:
         cost: float
             - The cost of the reservation"""
 
+        equipment_cost = self._machines()[equipment][1]
+
+        return self._price(equipment_cost, start_time, end_time)
+
+    def _price(self, equipment_cost: float, start_time: datetime.datetime, end_time: datetime.datetime) -> float:
+        """Applies the hourly rate and the early booking discount to a reservation
+        
+        Parameters
+        ----------
+        equipment_cost: float
+            - The hourly cost of the equipment
+        start_time: datetime.datetime
+            - The start time of the reservation
+        end_time: datetime.datetime
+            - The end time of the reservation
+            
+        Returns
+        -------
+        cost: float
+            - The cost of the reservation"""
+
         discount = 1
         if (start_time - datetime.datetime.now()).days >= 14:
             discount = 0.75
 
         reservation_duration = (end_time - start_time).seconds / 3600
 
-        equipment_cost = self.db.select('machines', 'cost', f"""equipment = '{equipment}' """)[0][0]
-
         return reservation_duration * equipment_cost * discount
 
     def _check_availability(self, equipment: str, start_time: datetime.datetime, end_time: datetime.datetime) -> bool:
@@ -82,18 +169,115 @@ class ReservationSystem:
         available: bool
             - True if the equipment is available, False otherwise"""
 
-        query_parameters = f"""equipment= '{equipment}'
-        AND start_date >='{start_time}' 
-        AND end_date <= '{end_time}'"""
-        overlapping_res = self.db.select('reservations', 'count(*)', query_parameters)
-        overlapping_res = overlapping_res[0][0]
+        max_machines_available = self._machines()[equipment][0]
+        self._follow()
+
+        return self._has_capacity(equipment, max_machines_available, start_time, end_time)
+
+    def _has_capacity(self, equipment: str, available: int, start_time: datetime.datetime,
+                      end_time: datetime.datetime) -> bool:
+        """Checks, with the interval index, that fewer than `available` units are in use
+        at the busiest moment of the time range"""
+
+        return self.index.peak_usage(equipment, to_epoch(start_time), to_epoch(end_time)) < available
+
+    def next_available(self, equipment_name: str, duration: datetime.timedelta, after: datetime.datetime,
+                       count: int = 1) -> list:
+        """Finds when an equipment can next be booked for a given duration
+
+        One sweep over the interval index replaces probing start times one by one
+        with _check_availability.
+
+        Parameters
+        ----------
+        equipment_name: str
+            - The name of the equipment
+        duration: datetime.timedelta
+            - The length of the booking
+        after: datetime.datetime
+            - The earliest start
+        count: int
+            - The number of free windows to return
+
+        Returns
+        -------
+        starts: list
+            - The earliest start of each of the next `count` windows long enough for the
+              booking, as datetimes; fewer when the equipment is free from the last on"""
+
+        equipment = self._find_equipment(equipment_name)
+        if not equipment:
+            raise ValueError("Equipment not found")
+        self._follow()
+        return self._free_starts(equipment, self._machines()[equipment][0], duration, after, count)
+
+    def _free_starts(self, equipment: str, available: int, duration: datetime.timedelta,
+                     after: datetime.datetime, count: int) -> list:
+        """The search of next_available once the index is up to date"""
 
-        max_machines_available = self.db.select('machines', 'available', f"""equipment = '{equipment}'""")[0][0]
+        seconds = int(duration.total_seconds())
+        if seconds <= 0:
+            raise ValueError("Duration must be positive")
+        if count < 1:
+            raise ValueError("Count must be positive")
+        starts = self.index.free_starts(equipment, available, to_epoch(after), seconds, count)
+        return [from_epoch(start) for start in starts]
 
-        if overlapping_res >= max_machines_available:
-            return False
+    def occupancy(self, equipment_name: str, start_date: datetime.datetime, end_date: datetime.datetime,
+                  bucket: datetime.timedelta) -> dict:
+        """Returns how many units of an equipment, or of every equipment, are in use in each
+        bucket of a time period
 
-        return True
+        The bookings come from the interval index, so a month of every equipment
+        takes no query.
+
+        Parameters
+        ----------
+        equipment_name: str
+            - The name of the equipment, None for every equipment
+        start_date: datetime.datetime
+            - The start of the first bucket
+        end_date: datetime.datetime
+            - The end of the time period
+        bucket: datetime.timedelta
+            - The length of a bucket
+
+        Returns
+        -------
+        occupancy: dict
+            - "starts", the start of every bucket, and "equipment", per equipment name its
+              "available" units and "in_use", the most units in use at once in every bucket"""
+
+        machines = self._machines()
+        if equipment_name is not None and equipment_name not in machines:
+            raise ValueError("Equipment not found")
+        self._follow()
+        intervals = self._occupied(machines, equipment_name, start_date, end_date, bucket)
+        return self._occupancy(machines, intervals, start_date, end_date, bucket)
+
+    def _occupied(self, machines: dict, equipment_name: str, start_date: datetime.datetime,
+                  end_date: datetime.datetime, bucket: datetime.timedelta) -> dict:
+        """Checks an occupancy request and returns the booked intervals within it, per equipment"""
+
+        start, end, seconds = to_epoch(start_date), to_epoch(end_date), int(bucket.total_seconds())
+        if seconds <= 0:
+            raise ValueError("Bucket must be positive")
+        if end <= start:
+            raise ValueError("End must be after start")
+        if -(-(end - start) // seconds) > OCCUPANCY_BUCKETS_MAX:
+            raise ValueError(f"More than {OCCUPANCY_BUCKETS_MAX} buckets")
+        names = [equipment_name] if equipment_name is not None else sorted(machines)
+        return {name: self.index.overlapping(name, start, end) for name in names}
+
+    @staticmethod
+    def _occupancy(machines: dict, intervals: dict, start_date: datetime.datetime, end_date: datetime.datetime,
+                   bucket: datetime.timedelta) -> dict:
+        """The per bucket usage of the intervals _occupied found"""
+
+        start, end, seconds = to_epoch(start_date), to_epoch(end_date), int(bucket.total_seconds())
+        return {"starts": [from_epoch(t) for t in range(start, end, seconds)],
+                "equipment": {name: {"available": machines[name][0], "in_use": occupancy(found, start, end, seconds)}
+                              for name, found in intervals.items()}}
 
     def make_reservation(self, customer_id: str, equipment_name: str, start_time: datetime.datetime,
                          end_time: datetime.datetime, x: str, y: str) -> float:
@@ -123,14 +307,24 @@ class ReservationSystem:
         if not equipment:
             raise ValueError("Equipment not found")
 
-        total_cost = self._calculate_cost(equipment_name, start_time, end_time)
-        down_payment = total_cost * 0.5
-
-        location_string = x + " " + y
-        self.db.add_reservation(
-            customer_id= customer_id, equipment= equipment_name, 
-            start_date= start_time, end_date= end_time, cost=total_cost, 
-            downpayment= down_payment, location=location_string)
+        # nothing else books this equipment between the check and the insert
+        with self.booking_locks.hold(equipment_name):
+            if not self._check_availability(equipment_name, start_time, end_time):
+                raise ValueError("Equipment not available")
+
+            total_cost = self._calculate_cost(equipment_name, start_time, end_time)
+            down_payment = total_cost * 0.5
+
+            location_string = x + " " + y
+            reservation_id = self.db.add_reservation(
+                customer_id= customer_id, equipment= equipment_name, 
+                start_date= start_time, end_date= end_time, cost=total_cost, 
+                downpayment= down_payment, location=location_string)
+            row = (customer_id, equipment_name, to_epoch(start_time), to_epoch(end_time), total_cost, down_payment,
+                   location_string)
+            self._index_reservations([row])
+            if self._withdraw_overbooked([row], reservation_id):
+                raise ValueError("Equipment not available")
         """
         location_string = "{" + x + "," + y + "}" 
         self.db.add_reservation(
@@ -140,6 +334,153 @@ class ReservationSystem:
         """
         return down_payment
 
+    def make_reservations(self, batch: list) -> list:
+        """Makes many reservations at once and returns one result per item
+
+        Availability is checked for the whole batch in memory, with the interval
+        index, against the reservations already booked and the items accepted
+        earlier in the same batch. The accepted rows are then written with a
+        single executemany in one transaction. The booking locks of every
+        equipment in the batch are held from the check to the insert.
+        
+        Parameters
+        ----------
+        batch: list
+            - (customer_id, equipment_name, start_time, end_time, x, y) tuples,
+              the same arguments make_reservation takes
+        
+        Returns
+        -------
+        results: list
+            - One {"success", "message", "downpayment"} dictionary per item, in order"""
+
+        machines = self._machines()
+
+        with self.booking_locks.hold(*self._batch_windows(batch, machines)):
+            self._follow()
+            results, rows = self._plan_reservations(batch, machines)
+            if rows:
+                last_id = self.db.add_reservations(rows)
+                self._index_reservations(rows)
+                self._mark_withdrawn(results, self._withdraw_overbooked(rows, last_id))
+
+        return results
+
+    @staticmethod
+    def _mark_withdrawn(results: list, withdrawn: set) -> None:
+        """Turns the results of the accepted rows at the `withdrawn` positions into refusals"""
+
+        accepted = [i for i, result in enumerate(results) if result["success"]]
+        for position in withdrawn:
+            results[accepted[position]] = {"success": False, "message": "Equipment not available", "downpayment": 0}
+
+    def _withdraw_overbooked(self, rows: list, last_id: int) -> set:
+        """Cancels the rows just committed that turn out to overbook their equipment
+
+        Only with SHARED_DB. Another process may have checked the same equipment
+        against the same index state and committed in between; once the index has
+        followed every change up to and including ours, a booking whose window now
+        holds more than the available units is withdrawn. Whichever of two such
+        bookings checks last sees the other and withdraws, so none is kept overbooked.
+
+        Parameters
+        ----------
+        rows: list
+            - The INSERT_RESERVATION rows written in one transaction
+        last_id: int
+            - The reservation_id of the last of them, the others precede it
+
+        Returns
+        -------
+        withdrawn: set
+            - The positions in rows of the cancelled reservations"""
+
+        if not SHARED_DB:
+            return set()
+        machines = self._machines()
+        withdrawn = {i for i, (_, equipment, start, end, _, _, _) in enumerate(rows)
+                     if self.index.peak_usage(equipment, start, end) > machines[equipment][0]}
+        first_id = last_id - len(rows) + 1
+        for i in withdrawn:
+            self.db.cancel_reservation(first_id + i)
+        if withdrawn:
+            self._follow()
+        return withdrawn
+
+    def _batch_windows(self, batch: list, machines: dict) -> dict:
+        """Returns the time window each known equipment in a batch spans"""
+
+        windows = {}
+        for _, equipment_name, start_time, end_time, _, _ in batch:
+            if equipment_name not in machines:
+                continue
+            start, end = windows.get(equipment_name, (start_time, end_time))
+            windows[equipment_name] = (min(start, start_time), max(end, end_time))
+        return windows
+
+    def _plan_reservations(self, batch: list, machines: dict) -> tuple:
+        """Validates a batch of reservations in memory
+        
+        The reservations already booked within the batch window are copied from
+        the interval index into a scratch index, which the accepted items of the
+        batch are added to as the batch is walked.
+        
+        Parameters
+        ----------
+        batch: list
+            - The batch passed to make_reservations
+        machines: dict
+            - Equipment name to (available, cost)
+        
+        Returns
+        -------
+        results, rows: tuple
+            - The per item results and the rows to insert for the accepted items"""
+
+        booked = []
+        for equipment, (start_time, end_time) in self._batch_windows(batch, machines).items():
+            booked += [(equipment, start, end)
+                       for start, end in self.index.overlapping(equipment, to_epoch(start_time), to_epoch(end_time))]
+        scratch = IntervalIndex()
+        scratch.load(booked)
+
+        results = []
+        rows = []
+
+        for customer_id, equipment_name, start_time, end_time, x, y in batch:
+            if equipment_name not in machines:
+                results.append({"success": False, "message": "Equipment not found", "downpayment": 0})
+                continue
+            if end_time <= start_time:
+                results.append({"success": False, "message": "End time must be after start time", "downpayment": 0})
+                continue
+
+            available, cost = machines[equipment_name]
+            start, end = to_epoch(start_time), to_epoch(end_time)
+            if scratch.peak_usage(equipment_name, start, end) >= available:
+                results.append({"success": False, "message": "Equipment not available", "downpayment": 0})
+                continue
+
+            total_cost = self._price(cost, start_time, end_time)
+            down_payment = total_cost * 0.5
+            rows.append((customer_id, equipment_name, start, end, total_cost, down_payment, f"{x} {y}"))
+            scratch.add(equipment_name, start, end)
+            results.append({"success": True, "message": "Reserved", "downpayment": down_payment})
+
+        return results, rows
+
+    def _index_reservations(self, rows: list) -> None:
+        """Adds inserted reservation rows to the interval index
+
+        With SHARED_DB the rows come in through the change log, in commit order
+        with those of the other processes."""
+
+        if SHARED_DB:
+            self._follow()
+            return
+        for _, equipment, start, end, _, _, _ in rows:
+            self.index.add(equipment, start, end)
+
     def cancel_reservation(self, reservation_id: int) -> float:
         """Cancels a reservation and returns the refund amount.
         
@@ -158,16 +499,116 @@ class ReservationSystem:
         refund: float
             - The refund amount"""
 
-        # check if it exists
-        if len(self.db.check_reservation(reservation_id)) == 0:
+        # cancel & get refund, the update only returns the row to the one cancel that made it inactive
+        cancelled = self.db.cancel_reservation(reservation_id)
+        if cancelled is None:
+            if self.db.check_reservation(reservation_id):
+                raise ValueError("Reservation already cancelled")
             raise ValueError("Reservation not found")
 
-        # cancel & get refund
-        downpayment, reservation_date = self.db.cancel_reservation(reservation_id)
-        refund = self._calculate_refund(downpayment, reservation_date)
+        equipment, start, end, downpayment = cancelled
+        self._unindex_reservation(equipment, start, end)
+        refund = self._calculate_refund(downpayment, from_epoch(start))
 
         return refund
 
+    def cancel_reservations(self, reservation_ids: list = None, username: str = None, equipment_name: str = None,
+                            start_date: datetime.datetime = None, end_date: datetime.datetime = None) -> dict:
+        """Cancels many reservations in one transaction and returns the refund of each
+
+        The active reservations are picked either by id or by a filter on customer,
+        equipment and time period (reservations within it, as the listings select
+        them); ids already cancelled or unknown are left out of the result. The
+        update returns the cancelled rows, so the refunds take no further query.
+
+        Parameters
+        ----------
+        reservation_ids: list
+            - The ids of the reservations to cancel
+        username: str
+            - Cancel the reservations of this customer
+        equipment_name: str
+            - Cancel the reservations of this equipment
+        start_date: datetime.datetime
+            - Cancel the reservations starting from then, together with end_date
+        end_date: datetime.datetime
+            - Cancel the reservations ending by then, together with start_date
+
+        Returns
+        -------
+        refunds: dict
+            - "refunds", the reservation_id and refund of every cancelled reservation, and "total_refund", their sum"""
+
+        condition, params = self._cancel_condition(reservation_ids, username, equipment_name, start_date, end_date)
+        rows = self.db.cancel_reservations(condition, params)
+        if SHARED_DB:
+            self._follow()
+        else:
+            self._unindex_cancelled(rows)
+        return self._refunds(rows)
+
+    def _cancel_condition(self, reservation_ids: list, username: str, equipment_name: str,
+                          start_date: datetime.datetime, end_date: datetime.datetime) -> tuple:
+        """The WHERE condition and parameters of a cancel_reservations selection"""
+
+        if reservation_ids is not None:
+            if username is not None or equipment_name is not None or start_date is not None or end_date is not None:
+                raise ValueError("Give either reservation ids or a filter, not both")
+            if not isinstance(reservation_ids, (list, tuple)) or not all(
+                    isinstance(i, int) and not isinstance(i, bool) for i in reservation_ids):
+                raise ValueError("Reservation ids must be a list of integers")
+            return "reservation_id IN (SELECT value FROM json_each(?))", (dumps(list(reservation_ids)).decode(),)
+
+        conditions, params = [], ()
+        if username is not None:
+            conditions.append("username = ?")
+            params += (username,)
+        if equipment_name is not None:
+            conditions.append("equipment = ?")
+            params += (equipment_name,)
+        if (start_date is None) != (end_date is None):
+            raise ValueError("Give both the start and the end of the period")
+        if start_date is not None:
+            conditions.append("start_date BETWEEN ? AND ? AND end_date <= ?")
+            params += self._period(start_date, end_date)
+        if not conditions:
+            raise ValueError("Give reservation ids or a filter")
+        return " AND ".join(conditions), params
+
+    def _unindex_cancelled(self, rows: list) -> None:
+        """Removes the rows cancel_reservations returned from the interval index, they were all active"""
+
+        for _, equipment, start, end, _ in rows:
+            self.index.remove(equipment, start, end)
+
+    def _refunds(self, rows: list) -> dict:
+        """Computes the refunds of cancelled (reservation_id, equipment, start_date, end_date, downpayment) rows
+        in one pass, against the same moment for all of them"""
+
+        now = to_epoch(datetime.datetime.now())
+        refunds = [{"reservation_id": reservation_id,
+                    "refund": self._refund_rate((start - now) // 86400) * downpayment}
+                   for reservation_id, _, start, _, downpayment in sorted(rows)]
+        return {"refunds": refunds, "total_refund": sum(refund["refund"] for refund in refunds)}
+
+    @staticmethod
+    def _refund_rate(days: int) -> float:
+        """The share of the downpayment refunded `days` whole days before the reservation starts"""
+
+        if days >= 7:
+            return 0.75
+        if days >= 2:
+            return 0.50
+        return 0
+
+    def _unindex_reservation(self, equipment: str, start: int, end: int) -> None:
+        """Removes a reservation this process just cancelled from the interval index"""
+
+        if SHARED_DB:
+            self._follow()
+            return
+        self.index.remove(equipment, start, end)
+
     def _calculate_refund(self, downpayment: int, reservation_date: datetime.datetime) -> float:
         """Calculates the refund amount for a given downpayment and reservation date
         
@@ -189,17 +630,81 @@ class ReservationSystem:
             - The refund amount"""
 
         days_difference = (reservation_date - datetime.datetime.now()).days
-        if days_difference >= 7:
-            refund = 0.75 * downpayment
-        elif days_difference >= 2:
-            refund = 0.50 * downpayment
-        else:
-            refund = 0
-        return refund
+        return self._refund_rate(days_difference) * downpayment
+
+    def _page(self, condition: str, params: tuple, key: str, limit: int = None, cursor: int = None) -> tuple:
+        """Adds keyset pagination on `key` to a select condition
+
+        Rows are ordered by key and only rows after the cursor are returned, so
+        every page is an index range scan no matter how deep it is. One row more
+        than the limit is fetched to tell whether another page follows.
+
+        Parameters
+        ----------
+        condition: str
+            - The WHERE condition of the select
+        params: tuple
+            - The parameters bound to the condition
+        key: str
+            - The unique, increasing column to page on
+        limit: int
+            - The page size, None for every row
+        cursor: int
+            - The last key of the previous page, None for the first page
 
-    def list_nicely(self, res: list) -> dict:
+        Returns
+        -------
+        condition, params: tuple
+            - The paged condition and its parameters"""
+
+        if condition != "1=1":
+            # the unary plus stops the planner from walking the whole table in key
+            # order to save the sort, it keeps to the index of the filter instead
+            key = "+" + key
+        if cursor is not None:
+            condition += f" AND {key} > ?"
+            params += (cursor,)
+        condition += f" ORDER BY {key}"
+        if limit is not None:
+            condition += " LIMIT ?"
+            params += (limit + 1,)
+        return condition, params
+
+    @staticmethod
+    def _period(start_date: datetime.datetime, end_date: datetime.datetime) -> tuple:
+        """The epoch parameters of a "start_date BETWEEN ? AND ? AND end_date <= ?" condition"""
+
+        start, end = to_epoch(start_date), to_epoch(end_date)
+        return start, end, end
+
+    @staticmethod
+    def _next_cursor(res: list, limit: int = None) -> tuple:
+        """Trims the look ahead row of a page and returns the cursor of the next page
+
+        Parameters
+        ----------
+        res: list
+            - The rows fetched with _page, the key in the first column
+        limit: int
+            - The page size the rows were fetched with
+
+        Returns
+        -------
+        res, next_cursor: tuple
+            - The rows of the page and the key to resume after, None on the last page"""
+
+        if limit is None or len(res) <= limit:
+            return res, None
+        res = res[:limit]
+        return res, res[-1][0]
+
+    def list_nicely(self, res: list, limit: int = None) -> dict:
         """Returns a dictionary of reservations to help parse and show the user
 
+        The dates are stored as epoch seconds and formatted back to text here.
+        When the rows were fetched a page at a time, next_cursor holds the
+        reservation_id to pass as cursor for the next page, or None on the last one.
+
         Dictory format:
         { "reservations": [ {
                     "reservation_id": 1,
@@ -212,13 +717,16 @@ class ReservationSystem:
                     "downpayment": 500.0,
                     "location": "(1, 1)"
                 }, 
-                ] }
+                ],
+          "next_cursor": None }
                 
         
         Parameters
         ----------
         res: list
             - The list of reservations to parse
+        limit: int
+            - The page size the reservations were fetched with, if any
         
         Returns
         -------
@@ -227,20 +735,62 @@ class ReservationSystem:
 
         reservations = {}
         rezos = []
+        res, next_cursor = self._next_cursor(res, limit)
 
         for i in res:
-            reservation = {"reservation_id": i[0], "username": i[1], "firstname": i[2], "equipment": i[3],
-                           "start_date": i[4], "end_date": i[5], "active": i[6], "cost": i[7], "downpayment": i[8],"location":i[9]}
-
-            rezos.append(reservation)
+            rezos.append(self._reservation_dict(i))
 
         reservations["reservations"] = rezos
+        reservations["next_cursor"] = next_cursor
 
         return reservations
 
-    def list_all_reservations(self) -> dict:
+    @staticmethod
+    def _reservation_dict(i: tuple) -> dict:
+        """Turns one reservations_view row into the dictionary shown to the user"""
+
+        return RESERVATION_ENCODER.as_dict(i)
+
+    @staticmethod
+    def _user_dict(i: tuple) -> dict:
+        """Turns one users row into the dictionary shown to the user"""
+
+        return USER_ENCODER.as_dict(i)
+
+    def encode_nicely(self, res: list, encoder: RowEncoder, key: str, limit: int = None) -> bytes:
+        """Returns the json list_nicely or list_users_nicely would give, encoded without building it
+
+        Parameters
+        ----------
+        res: list
+            - The list of rows to encode
+        encoder: RowEncoder
+            - The column layout of the rows
+        key: str
+            - The key the rows are listed under, "reservations" or "users"
+        limit: int
+            - The page size the rows were fetched with, if any
+
+        Returns
+        -------
+        listing: bytes
+            - The json object with the rows and next_cursor"""
+
+        res, next_cursor = self._next_cursor(res, limit)
+
+        return (b"{" + dumps(key) + b":" + encoder.encode_many(res)
+                + b',"next_cursor":' + dumps(next_cursor) + b"}")
+
+    def list_all_reservations(self, limit: int = None, cursor: int = None) -> dict:
         """Queries the reservation database and returns a dictionary of all reservations
 
+        Parameters
+        ----------
+        limit: int
+            - The maximum number of reservations to return, None for all
+        cursor: int
+            - The reservation_id the previous page ended on
+
         Returns
         -------
         reservations: dict
@@ -250,11 +800,13 @@ class ReservationSystem:
 
         logger.debug("list_all_reservations")
 
-        res = self.db.select("reservations_view", "*")
+        res = self.db.select("reservations_view", "*",
+                             *self._page("1=1", (), "reservation_id", limit, cursor))
 
-        return self.list_nicely(res)
+        return self.list_nicely(res, limit)
 
-    def list_reservations(self, start_date: datetime.datetime, end_date: datetime.datetime) -> dict:
+    def list_reservations(self, start_date: datetime.datetime, end_date: datetime.datetime,
+                          limit: int = None, cursor: int = None) -> dict:
         """Queries the reservation database and returns a dictionary of reservations within a given time period
         
         Parameters
@@ -263,18 +815,27 @@ class ReservationSystem:
             - The start date of the time period
         end_date: datetime.datetime
             - The end date of the time period
+        limit: int
+            - The maximum number of reservations to return, None for all
+        cursor: int
+            - The reservation_id the previous page ended on
         
         Returns
         -------
         reservations: dict
             - The dictionary of reservations"""
 
-        res = self.db.select("reservations_view", "*", f"start_date >= '{start_date}' AND end_date <= '{end_date}'")
+        # a reservation inside the period also starts before its end, which bounds
+        # the index range instead of reading every later reservation
+        res = self.db.select("reservations_view", "*",
+                             *self._page("start_date BETWEEN ? AND ? AND end_date <= ?",
+                                         self._period(start_date, end_date),
+                                         "reservation_id", limit, cursor))
 
-        return self.list_nicely(res)
+        return self.list_nicely(res, limit)
 
     def list_customer_reservations(self, username: str, start_date: datetime.datetime,
-                                   end_date: datetime.datetime) -> dict:
+                                   end_date: datetime.datetime, limit: int = None, cursor: int = None) -> dict:
         """Queries the reservation database and returns a dictionary of reservations for a given customer within a given time period
         
         Parameters
@@ -285,6 +846,10 @@ class ReservationSystem:
             - The start date of the time period
         end_date: datetime.datetime
             - The end date of the time period
+        limit: int
+            - The maximum number of reservations to return, None for all
+        cursor: int
+            - The reservation_id the previous page ended on
         
         Returns
         -------
@@ -292,12 +857,14 @@ class ReservationSystem:
             - The dictionary of reservations"""
         columns = "reservation_id, username, first_name, equipment, start_date, end_date, active, cost, downpayment, location"
         res = self.db.select("reservations_view", columns,
-                             f"username = '{username}' AND start_date >= '{start_date}' AND end_date <= '{end_date}'")
+                             *self._page("username = ? AND start_date BETWEEN ? AND ? AND end_date <= ?",
+                                         (username, *self._period(start_date, end_date)),
+                                         "reservation_id", limit, cursor))
 
-        return self.list_nicely(res)
+        return self.list_nicely(res, limit)
 
     def list_machine_reservations(self, equipment_name: str, start_date: datetime.datetime,
-                                  end_date: datetime.datetime):
+                                  end_date: datetime.datetime, limit: int = None, cursor: int = None):
         """Queries the reservation database and returns a dictionary of reservations for a given equipment within a given time period
         
         Parameters
@@ -308,6 +875,10 @@ class ReservationSystem:
             - The start date of the time period
         end_date: datetime.datetime
             - The end date of the time period
+        limit: int
+            - The maximum number of reservations to return, None for all
+        cursor: int
+            - The reservation_id the previous page ended on
         
         Returns
         -------
@@ -318,16 +889,12 @@ class ReservationSystem:
         if self._find_equipment(equipment_name) is None:
             return None
 
-        logger.debug(" - list_machine_reservations")
-
         res = self.db.select("reservations_view", "*",
-                             f"equipment = '{equipment_name}' AND start_date >= '{start_date}' AND end_date <= '{end_date}'")
+                             *self._page("equipment = ? AND start_date BETWEEN ? AND ? AND end_date <= ?",
+                                         (equipment_name, *self._period(start_date, end_date)),
+                                         "reservation_id", limit, cursor))
 
-        logger.debug(" - results:")
-        for i in res:
-            logger.debug(f" - {i}")
-
-        return self.list_nicely(res)
+        return self.list_nicely(res, limit)
 
     def remove_user(self, username: str) -> None:
         """Removes a user from the database
@@ -337,8 +904,9 @@ class ReservationSystem:
         username: str
             - The username of the customer
         """
-        print("to remove ", username)
+        logger.info("Removing user %s", username)
         self.db.remove_user(username)
+        self.identities.invalidate(username)
 
     def add_user(self, username: str, first_name: str, role: str) -> None:
         """Adds a user to the database
@@ -349,6 +917,7 @@ class ReservationSystem:
             - The username of the customer
         """
         self.db.add_user(username, first_name, role)
+        self.identities.invalidate(username)
 
     def change_user_role(self, username: str, role: str) -> None:
         """Updates a user in the database
@@ -362,6 +931,7 @@ class ReservationSystem:
 
         """
         self.db.change_user_role(username, role)
+        self.identities.invalidate(username)
 
     def login_user(self, username: str) -> str:
         """Returns the user object if it exists, otherwise returns None
@@ -375,9 +945,35 @@ class ReservationSystem:
         -------
         user: User
             - The user object if it exists, otherwise None"""
-        user_details = self.db.select('user_roles_view', '*', f"""username = '{username}' and active = 'TRUE' """)
-        print(user_details)
-        return user_details
+        return self._active_roles(self._identity(username))
+
+    def _identity(self, username: str) -> list:
+        """Returns the (user_id, username, first_name, active, role) rows of a username
+        
+        Identity lookups are the most frequent reads, so the rows are kept in a
+        bounded LRU cache with a TTL. Unknown usernames are cached as an empty
+        list. add_user, change_user_role and remove_user invalidate the entry.
+        
+        Parameters
+        ----------
+        username: str
+            - The username of the customer
+            
+        Returns
+        -------
+        rows: list
+            - The identity rows, empty if the user does not exist"""
+
+        rows = self.identities.get(username)
+        if rows is None:
+            rows = self.db.user_identity(username)
+            self.identities.put(username, rows)
+        return rows
+
+    def _active_roles(self, identity: list) -> list:
+        """Keeps the identity rows of an active user that has a role, as user_roles_view returns them"""
+
+        return [row for row in identity if row[3] == 'TRUE' and row[4] is not None]
 
     def _find_user(self, username: str) -> str:
         """Returns the user object if it exists, otherwise returns None
@@ -391,14 +987,20 @@ class ReservationSystem:
         -------
         user: User
             - The user object if it exists, otherwise None"""
-        print(f"""username = '{username}' """)
-        if self.db.select('users', '*', f"""username = '{username}' """):
+        if self._identity(username):
             return username
         return None
 
-    def list_all_users(self) -> dict:
+    def list_all_users(self, limit: int = None, cursor: int = None) -> dict:
         """Queries the user database and returns a dictionary of all users
 
+        Parameters
+        ----------
+        limit: int
+            - The maximum number of users to return, None for all
+        cursor: int
+            - The user_id the previous page ended on
+
         Returns
         -------
         users: dict
@@ -407,15 +1009,394 @@ class ReservationSystem:
         """
         logger.debug("list_all_users")
 
-        res = self.db.select("users", "*")
-        users = {"users": []}
-        for i in res:
-            users["users"].append({"user_id": i[0], "username": i[1], "first_name": i[2], "active": i[3]})
+        res = self.db.select("users", "*", *self._page("1=1", (), "user_id", limit, cursor))
+
+        return self.list_users_nicely(res, limit)
+
+    def list_users_nicely(self, res: list, limit: int = None) -> dict:
+        """Returns a dictionary of users to help parse and show the user
+
+        Parameters
+        ----------
+        res: list
+            - The list of users to parse
+        limit: int
+            - The page size the users were fetched with, if any
 
-            # users[i[0]] = users
+        Returns
+        -------
+        users: dict
+            - The dictionary of users"""
+
+        res, next_cursor = self._next_cursor(res, limit)
+        users = {"users": [], "next_cursor": next_cursor}
+        for i in res:
+            users["users"].append(self._user_dict(i))
 
         return users
 
 
+class AsyncReservationSystem(ReservationSystem):
+    """ReservationSystem whose queries run through aiosqlite
+
+    Every method that touches the database is a coroutine with the same name and
+    arguments as in ReservationSystem, so the api endpoints only need to await
+    them. Pure helpers (pricing, refunds, formatting) are inherited as is."""
+
+    def db_setup(self) -> None:
+        """Stand up database and apply the pending migrations, then switch to aiosqlite
+
+        The migrations run once, synchronously, at start up. Every query after
+        that goes through AsyncDBUtils."""
+
+        super().db_setup()
+        self.db.close()
+        self.db = AsyncDBUtils('reservation_system.db')
+        self.booking_locks = KeyedLocks(asyncio.Lock)
+        self.follow_lock = asyncio.Lock()
+
+    async def _follow(self) -> None:
+        """Async version of ReservationSystem._follow"""
+
+        if not SHARED_DB:
+            return
+        async with self.follow_lock:
+            changes = await self.db.reservation_changes(self.last_change)
+            if changes and changes[0][0] > self.last_change + 1:
+                intervals, self.last_change = await self.db.index_snapshot()
+                self.index.load(intervals)
+                return
+            self._apply_changes(changes)
+
+    async def _machines(self) -> dict:
+        """Async version of ReservationSystem._machines"""
+
+        if self.catalog.stale():
+            return self.catalog.fill(await self.db.list_machines())
+        return self.catalog.machines
+
+    async def _find_equipment(self, equipment_name: str) -> str:
+        """Async version of ReservationSystem._find_equipment"""
+
+        if equipment_name in await self._machines():
+            return equipment_name
+        return None
+
+    async def _calculate_cost(self, equipment: str, start_time: datetime.datetime, end_time: datetime.datetime) -> float:
+        """Async version of ReservationSystem._calculate_cost"""
+
+        equipment_cost = (await self._machines())[equipment][1]
+
+        return self._price(equipment_cost, start_time, end_time)
+
+    async def _check_availability(self, equipment: str, start_time: datetime.datetime,
+                                  end_time: datetime.datetime) -> bool:
+        """Async version of ReservationSystem._check_availability"""
+
+        max_machines_available = (await self._machines())[equipment][0]
+        await self._follow()
+
+        return self._has_capacity(equipment, max_machines_available, start_time, end_time)
+
+    async def next_available(self, equipment_name: str, duration: datetime.timedelta, after: datetime.datetime,
+                             count: int = 1) -> list:
+        """Async version of ReservationSystem.next_available"""
+
+        equipment = await self._find_equipment(equipment_name)
+        if not equipment:
+            raise ValueError("Equipment not found")
+        await self._follow()
+        return self._free_starts(equipment, (await self._machines())[equipment][0], duration, after, count)
+
+    async def occupancy(self, equipment_name: str, start_date: datetime.datetime, end_date: datetime.datetime,
+                        bucket: datetime.timedelta) -> dict:
+        """Async version of ReservationSystem.occupancy, a period with many bookings is counted on the read pool"""
+
+        machines = await self._machines()
+        if equipment_name is not None and equipment_name not in machines:
+            raise ValueError("Equipment not found")
+        await self._follow()
+        intervals = self._occupied(machines, equipment_name, start_date, end_date, bucket)
+        if sum(map(len, intervals.values())) > OFFLOAD_ROWS:
+            return await self.db.reads.call(self._occupancy, machines, intervals, start_date, end_date, bucket)
+        return self._occupancy(machines, intervals, start_date, end_date, bucket)
+
+    async def make_reservation(self, customer_id: str, equipment_name: str, start_time: datetime.datetime,
+                               end_time: datetime.datetime, x: str, y: str) -> float:
+        """Async version of ReservationSystem.make_reservation"""
+
+        equipment = await self._find_equipment(equipment_name)
+        if not equipment:
+            raise ValueError("Equipment not found")
+
+        # bookings of this equipment wait here, bookings of any other go ahead
+        async with self.booking_locks.hold_async(equipment_name):
+            if not await self._check_availability(equipment_name, start_time, end_time):
+                raise ValueError("Equipment not available")
+
+            total_cost = await self._calculate_cost(equipment_name, start_time, end_time)
+            down_payment = total_cost * 0.5
+
+            location_string = x + " " + y
+            reservation_id = await self.db.add_reservation(
+                customer_id=customer_id, equipment=equipment_name,
+                start_date=start_time, end_date=end_time, cost=total_cost,
+                downpayment=down_payment, location=location_string)
+            row = (customer_id, equipment_name, to_epoch(start_time), to_epoch(end_time), total_cost, down_payment,
+                   location_string)
+            # the booking is committed, what follows is not refused with Overloaded
+            with unbounded():
+                await self._index_reservations([row])
+                if await self._withdraw_overbooked([row], reservation_id):
+                    raise ValueError("Equipment not available")
+
+        return down_payment
+
+    async def make_reservations(self, batch: list) -> list:
+        """Async version of ReservationSystem.make_reservations"""
+
+        machines = await self._machines()
+
+        async with self.booking_locks.hold_async(*self._batch_windows(batch, machines)):
+            await self._follow()
+            results, rows = self._plan_reservations(batch, machines)
+            if rows:
+                last_id = await self.db.add_reservations(rows)
+                with unbounded():
+                    await self._index_reservations(rows)
+                    self._mark_withdrawn(results, await self._withdraw_overbooked(rows, last_id))
+
+        return results
+
+    async def _withdraw_overbooked(self, rows: list, last_id: int) -> set:
+        """Async version of ReservationSystem._withdraw_overbooked"""
+
+        if not SHARED_DB:
+            return set()
+        machines = await self._machines()
+        withdrawn = {i for i, (_, equipment, start, end, _, _, _) in enumerate(rows)
+                     if self.index.peak_usage(equipment, start, end) > machines[equipment][0]}
+        first_id = last_id - len(rows) + 1
+        for i in withdrawn:
+            await self.db.cancel_reservation(first_id + i)
+        if withdrawn:
+            await self._follow()
+        return withdrawn
+
+    async def _index_reservations(self, rows: list) -> None:
+        """Async version of ReservationSystem._index_reservations"""
+
+        if SHARED_DB:
+            await self._follow()
+            return
+        super()._index_reservations(rows)
+
+    async def _unindex_reservation(self, equipment: str, start: int, end: int) -> None:
+        """Async version of ReservationSystem._unindex_reservation"""
+
+        if SHARED_DB:
+            await self._follow()
+            return
+        super()._unindex_reservation(equipment, start, end)
+
+    async def cancel_reservation(self, reservation_id: int) -> float:
+        """Async version of ReservationSystem.cancel_reservation"""
+
+        # cancel & get refund
+        cancelled = await self.db.cancel_reservation(reservation_id)
+        if cancelled is None:
+            if await self.db.check_reservation(reservation_id):
+                raise ValueError("Reservation already cancelled")
+            raise ValueError("Reservation not found")
+
+        equipment, start, end, downpayment = cancelled
+        with unbounded():
+            await self._unindex_reservation(equipment, start, end)
+
+        return self._calculate_refund(downpayment, from_epoch(start))
+
+    async def cancel_reservations(self, reservation_ids: list = None, username: str = None,
+                                  equipment_name: str = None, start_date: datetime.datetime = None,
+                                  end_date: datetime.datetime = None) -> dict:
+        """Async version of ReservationSystem.cancel_reservations"""
+
+        condition, params = self._cancel_condition(reservation_ids, username, equipment_name, start_date, end_date)
+        rows = await self.db.cancel_reservations(condition, params)
+        if SHARED_DB:
+            with unbounded():
+                await self._follow()
+        else:
+            self._unindex_cancelled(rows)
+        return self._refunds(rows)
+
+    async def _select_reservations(self, columns: str, condition: str, params: tuple,
+                                   limit: int, cursor: int, stream: bool, encoded: bool):
+        """Runs a paged reservation listing, either all at once or as a stream
+
+        Parameters
+        ----------
+        columns: str
+            - The reservations_view columns to select, in list_nicely order
+        condition: str
+            - The WHERE condition of the listing
+        params: tuple
+            - The parameters bound to the condition
+        limit: int
+            - The maximum number of reservations to return, None for all
+        cursor: int
+            - The reservation_id the previous page ended on
+        stream: bool
+            - Return an async iterator over the reservations instead of a dictionary
+        encoded: bool
+            - Encode the result to json bytes straight from the rows
+
+        Returns
+        -------
+        reservations: dict, bytes or async iterator
+            - The dictionary of reservations or its json, or the reservations one at a time"""
+
+        condition, params = self._page(condition, params, "reservation_id", limit, cursor)
+        if stream:
+            return self._stream(self.db.select_iter("reservations_view", columns, condition, params),
+                                RESERVATION_ENCODER.encode if encoded else self._reservation_dict, limit)
+
+        res = await self.db.select("reservations_view", columns, condition, params)
+        if encoded:
+            return await self._convert(res, self.encode_nicely, res, RESERVATION_ENCODER, "reservations", limit)
+        return await self._convert(res, self.list_nicely, res, limit)
+
+    async def _convert(self, res: list, convert, *args):
+        """Runs convert(*args), on the read pool when there are enough rows in res to hold up the event loop"""
+
+        if len(res) > OFFLOAD_ROWS:
+            return await self.db.reads.call(convert, *args)
+        return convert(*args)
+
+    @staticmethod
+    async def _stream(rows, convert, limit: int = None):
+        """Maps rows read from the database cursor to dictionaries (or json) as they arrive
+
+        The look ahead row _page asks for is dropped, a stream has no next_cursor;
+        the reader resumes after the last id it received."""
+
+        count = 0
+        try:
+            async for row in rows:
+                if count == limit:
+                    break
+                count += 1
+                yield convert(row)
+        finally:
+            # closes the database cursor when we stop early or the client goes away
+            await rows.aclose()
+
+    async def list_all_reservations(self, limit: int = None, cursor: int = None, stream: bool = False,
+                                    encoded: bool = False) -> dict:
+        """Async version of ReservationSystem.list_all_reservations
+
+        With `stream` an async iterator over the reservations is returned instead,
+        with `encoded` the reservations come back as json bytes."""
+
+        return await self._select_reservations("*", "1=1", (), limit, cursor, stream, encoded)
+
+    async def list_reservations(self, start_date: datetime.datetime, end_date: datetime.datetime,
+                                limit: int = None, cursor: int = None, stream: bool = False,
+                                encoded: bool = False) -> dict:
+        """Async version of ReservationSystem.list_reservations
+
+        With `stream` an async iterator over the reservations is returned instead,
+        with `encoded` the reservations come back as json bytes."""
+
+        return await self._select_reservations("*", "start_date BETWEEN ? AND ? AND end_date <= ?",
+                                               self._period(start_date, end_date), limit, cursor,
+                                               stream, encoded)
+
+    async def list_customer_reservations(self, username: str, start_date: datetime.datetime,
+                                         end_date: datetime.datetime, limit: int = None,
+                                         cursor: int = None, stream: bool = False, encoded: bool = False) -> dict:
+        """Async version of ReservationSystem.list_customer_reservations
+
+        With `stream` an async iterator over the reservations is returned instead,
+        with `encoded` the reservations come back as json bytes."""
+
+        columns = "reservation_id, username, first_name, equipment, start_date, end_date, active, cost, downpayment, location"
+        return await self._select_reservations(columns, "username = ? AND start_date BETWEEN ? AND ? AND end_date <= ?",
+                                               (username, *self._period(start_date, end_date)),
+                                               limit, cursor, stream, encoded)
+
+    async def list_machine_reservations(self, equipment_name: str, start_date: datetime.datetime,
+                                        end_date: datetime.datetime, limit: int = None, cursor: int = None,
+                                        stream: bool = False, encoded: bool = False):
+        """Async version of ReservationSystem.list_machine_reservations
+
+        With `stream` an async iterator over the reservations is returned instead,
+        with `encoded` the reservations come back as json bytes."""
+
+        if await self._find_equipment(equipment_name) is None:
+            return None
+
+        return await self._select_reservations("*", "equipment = ? AND start_date BETWEEN ? AND ? AND end_date <= ?",
+                                               (equipment_name, *self._period(start_date, end_date)),
+                                               limit, cursor, stream, encoded)
+
+    async def remove_user(self, username: str) -> None:
+        """Async version of ReservationSystem.remove_user"""
+
+        logger.info("Removing user %s", username)
+        await self.db.remove_user(username)
+        self.identities.invalidate(username)
+
+    async def add_user(self, username: str, first_name: str, role: str) -> None:
+        """Async version of ReservationSystem.add_user"""
+
+        await self.db.add_user(username, first_name, role)
+        self.identities.invalidate(username)
+
+    async def change_user_role(self, username: str, role: str) -> None:
+        """Async version of ReservationSystem.change_user_role"""
+
+        await self.db.change_user_role(username, role)
+        self.identities.invalidate(username)
+
+    async def login_user(self, username: str) -> str:
+        """Async version of ReservationSystem.login_user"""
+
+        return self._active_roles(await self._identity(username))
+
+    async def _identity(self, username: str) -> list:
+        """Async version of ReservationSystem._identity"""
+
+        rows = self.identities.get(username)
+        if rows is None:
+            rows = await self.db.user_identity(username)
+            self.identities.put(username, rows)
+        return rows
+
+    async def _find_user(self, username: str) -> str:
+        """Async version of ReservationSystem._find_user"""
+
+        if await self._identity(username):
+            return username
+        return None
+
+    async def list_all_users(self, limit: int = None, cursor: int = None, stream: bool = False,
+                             encoded: bool = False) -> dict:
+        """Async version of ReservationSystem.list_all_users
+
+        With `stream` an async iterator over the users is returned instead,
+        with `encoded` the users come back as json bytes."""
+
+        condition, params = self._page("1=1", (), "user_id", limit, cursor)
+        if stream:
+            return self._stream(self.db.select_iter("users", "*", condition, params),
+                                USER_ENCODER.encode if encoded else self._user_dict, limit)
+
+        res = await self.db.select("users", "*", condition, params)
+        if encoded:
+            return await self._convert(res, self.encode_nicely, res, USER_ENCODER, "users", limit)
+
+        return await self._convert(res, self.list_users_nicely, res, limit)
+
+
 if __name__ == '__main__':
     pass
@@ -1,9 +1,9 @@
 import datetime
 from typing import List, Dict
-import os
 
 
-from db_utils import DBUtils
+from server.db_utils import DBUtils
+from server.db_migrations import MigrationRunner
 
 class Equipment:
     def __init__(self, name, availability, base_cost):
@@ -46,11 +46,7 @@ class ReservationSystem:
 
         self.db = DBUtils('reservation_system.db')
 
-        create_db = os.path.join(os.path.dirname(__file__), 'create_db.sql')
-        self.db.execute_script(create_db)
-
-        seed_data = os.path.join(os.path.dirname(__file__), 'seed_db.sql')
-        self.db.execute_script(seed_data)
+        MigrationRunner(self.db).run()
 
 
     # Can be removed
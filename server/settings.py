@@ -0,0 +1,77 @@
+"""Tunables for the reservation system
+
+Every value can be overridden with the environment variable of the same name
+prefixed with RES_, e.g. RES_READER_POOL_SIZE=8."""
+import os
+
+
+def _env(name, default, cast=str):
+    return cast(os.environ.get(f"RES_{name}", default))
+
+
+def _flag(name, default=False):
+    return _env(name, "1" if default else "0") not in ("0", "false", "False", "")
+
+
+# number of read only connections kept next to the writer
+READER_POOL_SIZE = _env("READER_POOL_SIZE", 4, int)
+# seconds a connection waits on a locked database before raising
+BUSY_TIMEOUT = _env("BUSY_TIMEOUT", 5.0, float)
+# times a write is retried when the database is still locked after BUSY_TIMEOUT, and the first
+# wait between tries, doubled on every retry
+BUSY_RETRIES = _env("BUSY_RETRIES", 5, int)
+BUSY_BACKOFF = _env("BUSY_BACKOFF_MS", 20.0, float) / 1000
+
+# other worker processes write to the same database: follow their bookings and cancellations
+# in the in-memory index, and check every booking again once it is committed. Only in this
+# mode do triggers log every booking and cancellation to reservation_changes for the others
+# to follow; every process on one database has to run with the same setting
+SHARED_DB = _flag("SHARED_DB")
+
+# queue writes from all callers and commit them together in one transaction
+GROUP_COMMIT = _flag("GROUP_COMMIT")
+# longest time a queued write waits for others to join its transaction
+GROUP_COMMIT_INTERVAL = _env("GROUP_COMMIT_INTERVAL_MS", 2.0, float) / 1000
+# writes per transaction before it is committed without waiting any longer
+GROUP_COMMIT_MAX_BATCH = _env("GROUP_COMMIT_MAX_BATCH", 64, int)
+
+# seconds before the equipment catalog is reloaded, to pick up edits made outside the service
+CATALOG_MAX_AGE = _env("CATALOG_MAX_AGE", 60.0, float)
+
+# usernames whose identity and role are kept in memory, and for how many seconds
+IDENTITY_CACHE_SIZE = _env("IDENTITY_CACHE_SIZE", 4096, int)
+IDENTITY_CACHE_TTL = _env("IDENTITY_CACHE_TTL", 30.0, float)
+
+# rows per page of the list endpoints when the caller does not ask for a limit, and the most it may ask for
+LIST_PAGE_SIZE = _env("LIST_PAGE_SIZE", 1000, int)
+LIST_PAGE_SIZE_MAX = _env("LIST_PAGE_SIZE_MAX", 10000, int)
+# rows read from sqlite per fetch, and encoded per chunk, when a listing is streamed
+STREAM_FETCH_SIZE = _env("STREAM_FETCH_SIZE", 256, int)
+
+# level of every logger, and per module overrides as "server.db_utils=DEBUG,server.res_system=INFO"
+LOG_LEVEL = _env("LOG_LEVEL", "WARNING")
+LOG_LEVELS = _env("LOG_LEVELS", "")
+# share of the per query debug records that are written
+LOG_QUERY_SAMPLE_RATE = _env("LOG_QUERY_SAMPLE_RATE", 0.01, float)
+# file the log lines go to, stderr when empty
+LOG_FILE = _env("LOG_FILE", "")
+
+# count and time the requests by route for GET /metrics, query and connection wait metrics are always kept
+METRICS = _flag("METRICS", True)
+
+# record every statement's duration by template, and log the plan of those slower than SLOW_QUERY_MS
+PROFILE_QUERIES = _flag("PROFILE_QUERIES")
+SLOW_QUERY_MS = _env("SLOW_QUERY_MS", 50.0, float)
+
+# threads of the read and write pools the event loop hands database calls and encoding to,
+# the calls that may queue behind them before new ones are refused with 503, and the seconds
+# a read may take, queueing included, or a write may wait for the writer; a write that has
+# begun always runs to its end
+EXECUTOR_READ_WORKERS = _env("EXECUTOR_READ_WORKERS", READER_POOL_SIZE, int)
+EXECUTOR_WRITE_WORKERS = _env("EXECUTOR_WRITE_WORKERS", 1, int)
+EXECUTOR_QUEUE_DEPTH = _env("EXECUTOR_QUEUE_DEPTH", 256, int)
+EXECUTOR_TIMEOUT = _env("EXECUTOR_TIMEOUT", 30.0, float)
+# pages of more rows than this are converted to dictionaries or json on the read pool, off the event loop
+OFFLOAD_ROWS = _env("OFFLOAD_ROWS", 500, int)
+# most buckets one occupancy request may ask for, a month by the minute is 44640
+OCCUPANCY_BUCKETS_MAX = _env("OCCUPANCY_BUCKETS_MAX", 50000, int)
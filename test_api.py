@@ -1,9 +1,29 @@
+import asyncio
+import json
+import os
+import tempfile
+
 import pytest
 from httpx import AsyncClient
-from api_service import app
+
+# api_service opens reservation_system.db in the working directory when it is imported,
+# a fresh one in a temporary directory keeps the tracked database out of the tests
+REPO_DIR = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="test_api_"))
+
+from api_service import app, sys  # noqa: E402
 
 base_url = "http://127.0.0.1:8000/reservation"
 
+
+@pytest.fixture(scope="module", autouse=True)
+def close_db():
+    '''The test client does not run the app lifespan, so close the database ourselves'''
+    yield
+    asyncio.run(sys.db.close())
+    os.chdir(REPO_DIR)
+
+
 @pytest.mark.asyncio
 async def test_get_all():
     async with AsyncClient(app=app, base_url=base_url) as ac:
@@ -103,3 +123,108 @@ async def test_add_and_delete_user():
 
     
 
+@pytest.mark.asyncio
+async def test_concurrent_requests():
+    '''Several list requests in flight at once all complete'''
+    async with AsyncClient(app=app, base_url=base_url) as ac:
+        responses = await asyncio.gather(
+            ac.get('/getall'),
+            ac.get("getbytime?start='2020-01-01 00:00'&end='2024-01-01 00:00'"),
+            ac.get("getbyequip?start='2020-01-01 00:00'&end='2024-01-01 00:00'&equipment_name='ore scooper'"),
+            ac.get("user?username='jdoe'"))
+
+    assert all(response.status_code == 200 for response in responses)
+    assert responses[3].json()['success'] == True
+
+@pytest.mark.asyncio
+async def test_get_by_user_quoted_name():
+    '''A quote in the user name is treated as data, not as SQL'''
+    async with AsyncClient(app=app, base_url=base_url) as ac:
+        response = await ac.get("getbyuser?start='2020-01-01 00:00'&end='2024-01-01 00:00'&user_name=x' OR '1'='1")
+    assert response.status_code == 200
+
+    assert len(response.json()['message']['reservations']) == 0
+
+@pytest.mark.asyncio
+async def test_bulk_reservations():
+    '''The harvester has a single unit, so the second identical booking in the batch is refused'''
+    booking = {
+	"user_name": "jdoe",
+	"equipment_name": "1.21 gigawatt lightning harvester",
+	"start_time": "2031-05-01 10:00",
+	"end_time": "2031-05-01 11:00",
+	"x_coor": 0,
+	"y_coor": 0}
+    data = [booking, booking, dict(booking, equipment_name="ore"), dict(booking, start_time="soon")]
+
+    async with AsyncClient(app=app, base_url=base_url) as ac:
+        response = await ac.post("/bulk", json=data)
+    assert response.status_code == 200
+
+    results = response.json()["message"]
+    assert len(results) == 4
+    assert results[1]["success"] == False
+    assert results[2]["message"] == "Equipment not found"
+    assert results[3]["success"] == False
+
+@pytest.mark.asyncio
+async def test_get_all_pages():
+    '''Following next_cursor walks the reservations in id order without repeating any'''
+    async with AsyncClient(app=app, base_url=base_url) as ac:
+        first = (await ac.get('/getall?limit=2')).json()['message']
+        second = (await ac.get(f"/getall?limit=2&cursor={first['next_cursor']}")).json()['message']
+
+    assert len(first['reservations']) == 2
+    assert first['next_cursor'] == first['reservations'][-1]['reservation_id']
+    assert second['reservations'][0]['reservation_id'] > first['next_cursor']
+
+@pytest.mark.asyncio
+async def test_get_all_stream():
+    '''A streamed listing sends one reservation per line, the same ones as the json listing'''
+    async with AsyncClient(app=app, base_url=base_url) as ac:
+        listing = (await ac.get('/getall?limit=10000')).json()['message']['reservations']
+        response = await ac.get('/getall', headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+
+    streamed = [json.loads(line) for line in response.text.splitlines()]
+    assert streamed == listing
+
+@pytest.mark.asyncio
+async def test_metrics():
+    '''Requests are counted by route template and queries by statement'''
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as ac:
+        await ac.get("/reservation/getbytime?start='2020-01-01 00:00'&end='2024-01-01 00:00'")
+        response = await ac.get("/metrics")
+    assert response.status_code == 200
+
+    metrics = response.text
+    assert 'http_requests_total{method="GET",route="/reservation/getbytime",status="200"}' in metrics
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/reservation/getbytime",le="+Inf"}' in metrics
+    assert 'db_query_duration_seconds_count{statement="SELECT * FROM reservations_view WHERE' in metrics
+
+@pytest.mark.asyncio
+async def test_occupancy():
+    '''Every machine gets one count per bucket, a malformed bucket is refused'''
+    async with AsyncClient(app=app, base_url=base_url) as ac:
+        response = await ac.get("occupancy?start='2020-01-01 00:00'&end='2020-01-02 00:00'&bucket=6h")
+        wrong = await ac.get("occupancy?equipment_name='ore scooper'&start='2020-01-01 00:00'"
+                             "&end='2020-01-02 00:00'&bucket=6x")
+        huge = await ac.get("occupancy?start='2020-01-01 00:00'&end='2020-01-02 00:00'&bucket=99999999999999d")
+    assert response.status_code == 200
+
+    occupancy = response.json()
+    assert occupancy["starts"] == ["2020-01-01 00:00", "2020-01-01 06:00", "2020-01-01 12:00", "2020-01-01 18:00"]
+    assert all(len(machine["in_use"]) == 4 for machine in occupancy["equipment"].values())
+    assert wrong.json()["success"] == False
+    assert huge.status_code == 200
+    assert huge.json()["success"] == False
+
+@pytest.mark.asyncio
+async def test_bulk_cancel_wrong_types():
+    '''Filters that are not strings are refused, not answered with a server error'''
+    async with AsyncClient(app=app, base_url=base_url) as ac:
+        response = await ac.request("DELETE", "cancel/bulk", json={"start": 5, "end": 6})
+    assert response.status_code == 200
+    assert response.json()["success"] == False
+    assert response.json()["refunds"] == []
@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from server import logs
+from server.db_migrations import MigrationRunner
+from server.db_utils import DBUtils
+from server.executor import BoundedExecutor, Overloaded
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DBUtils(str(tmp_path / "test.db"), group_commit=True)
+    db.create_table("items", "item_id INTEGER PRIMARY KEY, name VARCHAR UNIQUE")
+    yield db
+    db.close()
+
+
+def test_group_commit_concurrent_writes(db):
+    '''Writes from many threads are all committed and visible once they return'''
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: db.insert("items", "name", "?", (f"item {i}",)), range(100)))
+
+    assert db.select("items", "count(*)")[0][0] == 100
+
+
+def test_group_commit_failed_write_is_isolated(db):
+    '''A failing statement raises for its own caller only'''
+    db.insert("items", "name", "?", ("duplicate",))
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db.insert("items", "name", "?", ("duplicate",))
+
+    db.insert("items", "name", "?", ("other",))
+    assert db.select("items", "count(*)")[0][0] == 2
+
+
+def test_migrations_apply_once(tmp_path):
+    '''A new database gets every migration, starting again applies none'''
+    db = DBUtils(str(tmp_path / "test.db"))
+
+    runner = MigrationRunner(db)
+    assert runner.run() == [version for version, _, _ in runner.migrations()]
+    assert runner.run() == []
+
+    # seed data survives the second start up
+    assert db.select("machines", "count(*)")[0][0] == 3
+    db.close()
+
+
+@pytest.mark.parametrize("rate, expected", [(0.0, 0), (1.0, 3)])
+def test_query_logs_are_sampled(db, rate, expected):
+    '''Per query records go out as json lines, only for the sampled share of the queries'''
+    out = io.StringIO()
+    logs.configure(level="WARNING", levels="server.db_utils=DEBUG", sample_rate=rate, stream=out)
+    try:
+        for _ in range(3):
+            db.select("items", "count(*)")
+    finally:
+        logs.shutdown()
+        logging.getLogger("server.db_utils").setLevel(logging.NOTSET)
+
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert len(lines) == expected
+    assert all(line["query"] == "SELECT count(*) FROM items WHERE 1=1" for line in lines)
+
+
+def test_profiler_logs_slow_queries_with_plan(tmp_path, caplog):
+    '''Every query over the threshold is logged with its plan, and counted by template'''
+    db = DBUtils(str(tmp_path / "test.db"), profile=True)
+    db.create_table("items", "item_id INTEGER PRIMARY KEY, name VARCHAR")
+    db.profiler.threshold = 0
+    try:
+        with caplog.at_level(logging.WARNING, logger="server.db_utils.slow"):
+            for name in ("a", "b"):
+                db.select("items", "*", "name = ?", (name,))
+    finally:
+        db.close()
+
+    slow = [record for record in caplog.records if record.name == "server.db_utils.slow"]
+    assert len(slow) == 2
+    assert slow[0].statement == "SELECT * FROM items WHERE name = ?"
+    assert any("SCAN items" in line for line in slow[0].plan)
+
+    stats = {stats["statement"]: stats for stats in db.profiler.top(10, "max")}
+    assert stats["SELECT * FROM items WHERE name = ?"]["count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_bounded_executor_refuses_and_times_out():
+    '''Calls past the workers and queue are refused, calls past the timeout fail, a begun write is not timed'''
+    executor = BoundedExecutor("read", workers=1, queue_depth=1, timeout=0.2)
+    release = threading.Event()
+    held = [asyncio.ensure_future(executor.call(release.wait)) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    with pytest.raises(Overloaded):
+        await executor.call(time.sleep, 0)
+    release.set()
+    assert await asyncio.gather(*held) == [True, True]
+
+    with pytest.raises(Overloaded):
+        await executor.call(time.sleep, 0.5)
+
+    async def write():
+        await asyncio.sleep(0.3)
+        return "committed"
+
+    assert await executor.wait(write(), finish=True) == "committed"
+
+    # the wait for the writer is what is timed
+    lock = asyncio.Lock()
+    await lock.acquire()
+    with pytest.raises(Overloaded):
+        await executor.acquire(lock)
+    lock.release()
+    await executor.acquire(lock)
+    assert lock.locked()
+    executor.shutdown()
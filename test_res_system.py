@@ -0,0 +1,301 @@
+import asyncio
+import datetime
+import json
+
+import pytest
+
+from server import interval_index, res_system as res_system_module, serialize
+from server.executor import Overloaded
+from server.interval_index import IntervalIndex
+from server.res_system import RESERVATION_ENCODER, AsyncReservationSystem, ReservationSystem
+
+
+@pytest.fixture
+def res_system(tmp_path, monkeypatch):
+    '''A ReservationSystem on a fresh, seeded database'''
+    monkeypatch.chdir(tmp_path)
+    res_system = ReservationSystem()
+    yield res_system
+    res_system.db.close()
+
+
+def test_interval_index_peak_usage():
+    index = IntervalIndex()
+    index.load([("scanner", 0, 10), ("scanner", 5, 15), ("scanner", 20, 30)])
+
+    assert index.peak_usage("scanner", 0, 30) == 2
+    # back to back bookings do not overlap
+    assert index.peak_usage("scanner", 15, 20) == 0
+    assert index.peak_usage("harvester", 0, 30) == 0
+
+    assert index.remove("scanner", 5, 15)
+    assert index.peak_usage("scanner", 0, 30) == 1
+
+
+def test_make_reservation_respects_capacity(res_system):
+    '''The harvester has a single unit, a second overlapping booking is refused'''
+    start = datetime.datetime(2031, 1, 1, 10, 0)
+    end = datetime.datetime(2031, 1, 1, 12, 0)
+
+    res_system.make_reservation("jdoe", "1.21 gigawatt lightning harvester", start, end, "0", "0")
+    with pytest.raises(ValueError):
+        res_system.make_reservation("jp", "1.21 gigawatt lightning harvester",
+                                    start + datetime.timedelta(hours=1), end + datetime.timedelta(hours=1), "0", "0")
+
+    # cancelling frees the unit again
+    reservation_id = res_system.db.select("reservations", "max(reservation_id)")[0][0]
+    res_system.cancel_reservation(reservation_id)
+    res_system.make_reservation("jp", "1.21 gigawatt lightning harvester", start, end, "0", "0")
+
+    # a process alone on the database keeps no change log
+    assert res_system.db.select("reservation_changes", "count(*)")[0][0] == 0
+
+
+def test_cancel_reservations_in_bulk(res_system):
+    '''A filter cancels every matching booking at once, with the refund of each and the unit freed'''
+    start = datetime.datetime.now().replace(minute=0, second=0, microsecond=0) + datetime.timedelta(days=10)
+    for day in range(3):
+        res_system.make_reservation("jp", "1.21 gigawatt lightning harvester", start + datetime.timedelta(days=day),
+                                    start + datetime.timedelta(days=day, hours=2), "0", "0")
+    first_id = res_system.db.select("reservations", "max(reservation_id)")[0][0] - 2
+
+    with pytest.raises(ValueError):
+        res_system.cancel_reservations()
+    # a string is not read as the ids of its digits
+    for ids in ["123", str(first_id), [str(first_id)], [True], {first_id: first_id}]:
+        with pytest.raises(ValueError):
+            res_system.cancel_reservations(reservation_ids=ids)
+
+    cancelled = res_system.cancel_reservations(reservation_ids=[first_id, 10 ** 9])
+    assert [refund["reservation_id"] for refund in cancelled["refunds"]] == [first_id]
+
+    # 10 days ahead, 75% of the downpayment comes back
+    downpayment = res_system.db.select("reservations", "downpayment", "reservation_id = ?", (first_id,))[0][0]
+    cancelled = res_system.cancel_reservations(username="jp", equipment_name="1.21 gigawatt lightning harvester",
+                                               start_date=start, end_date=start + datetime.timedelta(days=5))
+    assert cancelled["refunds"] == [{"reservation_id": first_id + 1, "refund": 0.75 * downpayment},
+                                    {"reservation_id": first_id + 2, "refund": 0.75 * downpayment}]
+    assert cancelled["total_refund"] == 2 * 0.75 * downpayment
+
+    # cancelled ones are not cancelled twice, and their units are free again
+    assert res_system.cancel_reservations(reservation_ids=[first_id])["refunds"] == []
+    res_system.make_reservation("jdoe", "1.21 gigawatt lightning harvester", start + datetime.timedelta(days=2),
+                                start + datetime.timedelta(days=2, hours=2), "0", "0")
+
+
+def test_next_available(res_system):
+    '''The search skips windows the booking does not fit in, and agrees with the availability check'''
+    harvester = "1.21 gigawatt lightning harvester"
+    day = datetime.datetime(2031, 1, 1)
+    for start, end in [(9, 11), (12, 17), (18, 20)]:
+        res_system.make_reservation("jdoe", harvester, day + datetime.timedelta(hours=start),
+                                    day + datetime.timedelta(hours=end), "0", "0")
+
+    starts = res_system.next_available(harvester, datetime.timedelta(hours=1), day + datetime.timedelta(hours=10), 3)
+    assert starts == [day + datetime.timedelta(hours=11), day + datetime.timedelta(hours=17),
+                      day + datetime.timedelta(hours=20)]
+    # an hour and a half fits neither the 11:00 nor the 17:00 gap
+    starts = res_system.next_available(harvester, datetime.timedelta(minutes=90), day + datetime.timedelta(hours=10), 3)
+    assert starts == [day + datetime.timedelta(hours=20)]
+    assert res_system._check_availability(harvester, starts[0], starts[0] + datetime.timedelta(minutes=90))
+
+    with pytest.raises(ValueError):
+        res_system.next_available("flux capacitor", datetime.timedelta(hours=1), day)
+
+
+@pytest.mark.parametrize("use_numpy", [
+    pytest.param(True, marks=pytest.mark.skipif(interval_index.numpy is None, reason="numpy is not installed")),
+    False])
+def test_occupancy(res_system, monkeypatch, use_numpy):
+    '''Each bucket counts the most units in use at once, with or without numpy'''
+    if not use_numpy:
+        monkeypatch.setattr(interval_index, "numpy", None)
+    scanner = "multi-phasic radiation scanner"
+    day = datetime.datetime(2031, 1, 1)
+    for start, end in [(9, 11), (10, 12), (12, 13), (15, 16)]:
+        res_system.make_reservation("jdoe", scanner, day + datetime.timedelta(hours=start),
+                                    day + datetime.timedelta(hours=end), "0", "0")
+
+    occupancy = res_system.occupancy(scanner, day + datetime.timedelta(hours=8), day + datetime.timedelta(hours=16),
+                                     datetime.timedelta(hours=2))
+    assert occupancy["starts"] == [day + datetime.timedelta(hours=hour) for hour in (8, 10, 12, 14)]
+    # the bookings back to back at 12:00 do not overlap
+    assert occupancy["equipment"] == {scanner: {"available": 4, "in_use": [1, 2, 1, 1]}}
+
+    everything = res_system.occupancy(None, day, day + datetime.timedelta(days=1), datetime.timedelta(days=1))
+    assert everything["equipment"][scanner]["in_use"] == [2]
+    assert len(everything["equipment"]) == len(res_system._machines())
+
+    with pytest.raises(ValueError):
+        res_system.occupancy(scanner, day, day + datetime.timedelta(days=365), datetime.timedelta(minutes=1))
+
+
+@pytest.mark.asyncio
+async def test_concurrent_bookings_do_not_overbook(tmp_path, monkeypatch):
+    '''Bookings racing for the single harvester unit get it once, other equipment is not held up'''
+    monkeypatch.chdir(tmp_path)
+    system = AsyncReservationSystem()
+    start = datetime.datetime(2031, 1, 1, 10, 0)
+    end = datetime.datetime(2031, 1, 1, 12, 0)
+
+    async def book(equipment):
+        try:
+            await system.make_reservation("jdoe", equipment, start, end, "0", "0")
+            return True
+        except ValueError:
+            return False
+
+    try:
+        harvester = await asyncio.gather(*(book("1.21 gigawatt lightning harvester") for _ in range(10)))
+        scanner = await asyncio.gather(*(book("multi-phasic radiation scanner") for _ in range(10)))
+        assert sum(harvester) == 1
+        assert sum(scanner) == 4
+        assert not system.booking_locks.locks
+    finally:
+        await system.db.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_cancels_free_one_unit(tmp_path, monkeypatch):
+    '''Two cancels of the same booking racing each other refund and free it once'''
+    monkeypatch.chdir(tmp_path)
+    system = AsyncReservationSystem()
+    scanner = "multi-phasic radiation scanner"
+    start = datetime.datetime(2031, 1, 1, 10, 0)
+    end = datetime.datetime(2031, 1, 1, 12, 0)
+
+    try:
+        for _ in range(4):
+            await system.make_reservation("jdoe", scanner, start, end, "0", "0")
+        reservation_id = (await system.db.select("reservations", "max(reservation_id)"))[0][0]
+
+        cancels = await asyncio.gather(system.cancel_reservation(reservation_id),
+                                       system.cancel_reservation(reservation_id), return_exceptions=True)
+        assert sum(isinstance(cancel, ValueError) for cancel in cancels) == 1
+
+        # one unit came free, not two
+        await system.make_reservation("jp", scanner, start, end, "0", "0")
+        with pytest.raises(ValueError):
+            await system.make_reservation("jp", scanner, start, end, "0", "0")
+        with pytest.raises(ValueError, match="already cancelled"):
+            await system.cancel_reservation(reservation_id)
+    finally:
+        await system.db.close()
+
+
+@pytest.mark.asyncio
+async def test_write_timeout_never_reports_a_committed_booking(tmp_path, monkeypatch):
+    '''A booking refused with Overloaded was not written, so the index and the database agree'''
+    monkeypatch.chdir(tmp_path)
+    system = AsyncReservationSystem()
+    harvester = "1.21 gigawatt lightning harvester"
+    start = datetime.datetime(2031, 1, 1, 10, 0)
+    end = datetime.datetime(2031, 1, 1, 12, 0)
+
+    try:
+        system.db.writes.timeout = 0
+        with pytest.raises(Overloaded):
+            await system.make_reservation("jdoe", harvester, start, end, "0", "0")
+        # long enough for a write left running to commit
+        await asyncio.sleep(0.2)
+        assert await system.db.select("reservations", "count(*)", "start_date = ?",
+                                      (res_system_module.to_epoch(start),)) == [(0,)]
+
+        system.db.writes.timeout = None
+        await system.make_reservation("jdoe", harvester, start, end, "0", "0")
+        with pytest.raises(ValueError):
+            await system.make_reservation("jp", harvester, start, end, "0", "0")
+    finally:
+        await system.db.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_bookings_follow_the_log_once(tmp_path, monkeypatch):
+    '''Concurrent bookings of different equipment in shared mode apply each logged change to the index once'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(res_system_module, "SHARED_DB", True)
+    system = AsyncReservationSystem()
+    equipment = ["1.21 gigawatt lightning harvester", "multi-phasic radiation scanner", "ore scooper"]
+    day = datetime.datetime(2031, 1, 1, 10, 0)
+
+    async def book(i):
+        start = day + datetime.timedelta(days=i)
+        await system.make_reservation("jdoe", equipment[i % 3], start, start + datetime.timedelta(hours=2), "0", "0")
+
+    try:
+        await asyncio.gather(*(book(i) for i in range(15)))
+        active = (await system.db.select("reservations", "count(*)", "active = TRUE"))[0][0]
+        assert sum(len(starts) for starts in system.index.starts.values()) == active
+    finally:
+        await system.db.close()
+
+
+def test_shared_database_follows_other_processes(res_system, monkeypatch):
+    '''With SHARED_DB a second system on the same database sees the first one's bookings,
+    and withdraws a booking that raced another one past the capacity'''
+    monkeypatch.setattr(res_system_module, "SHARED_DB", True)
+    other = ReservationSystem()
+    harvester = "1.21 gigawatt lightning harvester"
+    start = datetime.datetime(2031, 1, 1, 10, 0)
+    end = datetime.datetime(2031, 1, 1, 12, 0)
+
+    try:
+        res_system.make_reservation("jdoe", harvester, start, end, "0", "0")
+        with pytest.raises(ValueError):
+            other.make_reservation("jp", harvester, start, end, "0", "0")
+
+        # both checked the next window before either committed
+        later = start + datetime.timedelta(days=1), end + datetime.timedelta(days=1)
+        first_id = res_system.db.add_reservation("jdoe", harvester, *later, 100, 50, "0 0")
+        row = ("jp", harvester, res_system_module.to_epoch(later[0]), res_system_module.to_epoch(later[1]),
+               100, 50, "0 0")
+        second_id = other.db.add_reservation(*row[:2], *later, *row[4:])
+        other._index_reservations([row])
+
+        assert other._withdraw_overbooked([row], second_id) == {0}
+        active = dict(other.db.select("reservations", "reservation_id, active", "reservation_id IN (?, ?)",
+                                      (first_id, second_id)))
+        assert active == {first_id: 1, second_id: 0}
+    finally:
+        other.db.close()
+
+
+def test_equipment_catalog_is_cached(res_system):
+    '''Equipment lookups are served from the catalog until it is invalidated'''
+    assert res_system._find_equipment("ore scooper") == "ore scooper"
+
+    res_system.db.insert("machines", "equipment, available, cost", "?, ?, ?", ("flux capacitor", 1, 10))
+    assert res_system._find_equipment("flux capacitor") is None
+
+    res_system.catalog.invalidate()
+    assert res_system._find_equipment("flux capacitor") == "flux capacitor"
+
+
+def test_identity_cache_invalidated_on_user_changes(res_system):
+    '''Logins are served from the cache, and user changes are visible right away'''
+    assert res_system.login_user("jdoe")[0][4] == "customer"
+    assert res_system._find_user("newbie") is None
+
+    res_system.add_user("newbie", "New", "customer")
+    assert res_system._find_user("newbie") == "newbie"
+
+    res_system.change_user_role("jdoe", "admin")
+    assert res_system.login_user("jdoe")[0][4] == "admin"
+
+    res_system.remove_user("jdoe")
+    assert res_system.login_user("jdoe") == []
+
+
+@pytest.mark.parametrize("use_orjson", [
+    pytest.param(True, marks=pytest.mark.skipif(serialize.orjson is None, reason="orjson is not installed")),
+    False])
+def test_encode_nicely_matches_list_nicely(res_system, monkeypatch, use_orjson):
+    '''The json encoded straight from the rows is the same as list_nicely's dictionary'''
+    if not use_orjson:
+        monkeypatch.setattr(serialize, "orjson", None)
+    rows = [(99, 'o"neil', "Ren\u00e9e", "ore scooper", 0, 3600, 1, 10.5, 5.25, None)]
+    rows += res_system.db.select("reservations_view", "*")
+
+    encoded = res_system.encode_nicely(rows, RESERVATION_ENCODER, "reservations", limit=len(rows) - 1)
+
+    assert json.loads(encoded) == res_system.list_nicely(rows, limit=len(rows) - 1)